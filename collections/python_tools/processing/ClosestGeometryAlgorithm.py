@@ -1,12 +1,30 @@
+import copy
 import sys
+import tempfile
+import threading
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from qgis.PyQt.QtCore import QVariant, QCoreApplication
 from qgis.core import (QgsProcessing, QgsProcessingAlgorithm, QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterField, QgsFeature, QgsProcessingParameterFeatureSink,
                        QgsProcessingException, QgsFields, QgsField, QgsPoint, QgsWkbTypes,
-                       QgsGeometryUtils, QgsLineString, QgsPolygon, QgsProcessingFeedback,
+                       QgsGeometryUtils, QgsLineString, QgsProcessingFeedback,
                        QgsCoordinateTransform, QgsProject, QgsGeometry, QgsAbstractGeometry,
-                       QgsMultiPoint, QgsMultiLineString, QgsMultiPolygon)
+                       QgsFeatureRequest, QgsFeatureSource, QgsPointXY, QgsRectangle,
+                       QgsSpatialIndex, QgsFeatureSink, QgsProcessingParameterNumber,
+                       QgsProcessingParameterDefinition, QgsProcessingParameterDistance,
+                       QgsProcessingParameterEnum, QgsProcessingUtils,
+                       QgsCoordinateReferenceSystem, QgsMemoryProviderUtils)
+
+numpy_available = True
+try:
+    import numpy as np
+except ImportError:
+    numpy_available = False
 
 
 class ClosestGeometryAlgorithm(QgsProcessingAlgorithm):
@@ -15,8 +33,17 @@ class ClosestGeometryAlgorithm(QgsProcessingAlgorithm):
     INPUT_POINTS_ID = 'INPUTPOINTSID'
     CLOSEST_GEOM = 'CLOSESTGEOM'
     CLOSEST_GEOM_ID = 'CLOSESTGEOMID'
+    K = 'K'
+    MAX_DISTANCE = 'MAX_DISTANCE'
+    THREADS = 'THREADS'
+    ENGINE = 'ENGINE'
     OUTPUT = 'OUTPUT'
 
+    ENGINES = ['QGIS geometry', 'NumPy']
+
+    # number of input points processed by one task
+    CHUNK_SIZE = 1000
+
     def createInstance(self):
         return ClosestGeometryAlgorithm()
 
@@ -33,7 +60,21 @@ class ClosestGeometryAlgorithm(QgsProcessingAlgorithm):
         return 'vectortools'
 
     def shortHelpString(self):
-        return self.tr("Closest Geometry")
+        return self.tr("Closest Geometry\n\n"
+                       "For every input point finds the closest feature of the closest feature "
+                       "layer. Closest feature layer is loaded into a spatial index once and the "
+                       "exact distance is only calculated for candidates selected by the "
+                       "index.\n\n"
+                       "Input points are processed in chunks, with more than one thread the "
+                       "chunks are processed in parallel and written to the output in input "
+                       "order.\n\n"
+                       "With number of closest features larger than 1, the closest features are "
+                       "output as separate features ordered by rank. If maximum distance is set "
+                       "only features within this distance are searched for and points without "
+                       "any such feature are not part of the output.\n\n"
+                       "NumPy engine calculates distances to points, lines and polygons on "
+                       "coordinate arrays extracted once from the closest feature layer, curved "
+                       "geometries are processed by QGIS geometry engine.")
 
     def initAlgorithm(self, config=None):
 
@@ -56,6 +97,38 @@ class ClosestGeometryAlgorithm(QgsProcessingAlgorithm):
                 self.tr('Field with identification values for closest geometry'),
                 parentLayerParameterName=self.CLOSEST_GEOM))
 
+        self.addParameter(
+            QgsProcessingParameterNumber(self.K,
+                                         self.tr('Number of closest features per point'),
+                                         type=QgsProcessingParameterNumber.Integer,
+                                         minValue=1,
+                                         defaultValue=1))
+
+        self.addParameter(
+            QgsProcessingParameterDistance(self.MAX_DISTANCE,
+                                           self.tr('Maximum distance'),
+                                           parentParameterName=self.INPUT_POINTS,
+                                           minValue=0,
+                                           defaultValue=None,
+                                           optional=True))
+
+        engine_param = QgsProcessingParameterEnum(self.ENGINE,
+                                                  self.tr('Distance calculation engine'),
+                                                  self.ENGINES,
+                                                  allowMultiple=False,
+                                                  defaultValue=0)
+        engine_param.setFlags(engine_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(engine_param)
+
+        threads_param = QgsProcessingParameterNumber(self.THREADS,
+                                                     self.tr('Number of threads'),
+                                                     type=QgsProcessingParameterNumber.Integer,
+                                                     minValue=1,
+                                                     defaultValue=1)
+        threads_param.setFlags(threads_param.flags() |
+                               QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(threads_param)
+
         self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, self.tr('Output layer')))
 
     def processAlgorithm(self, parameters, context, feedback: QgsProcessingFeedback):
@@ -86,80 +159,125 @@ class ClosestGeometryAlgorithm(QgsProcessingAlgorithm):
         id_field_closest_geometry = closest_layer.fields().field(id_field_name)
         id_field_input_points = input_points.fields().field(id_field_name_input_points)
 
+        k = self.parameterAsInt(parameters, self.K, context)
+
+        if self.MAX_DISTANCE in parameters and parameters[self.MAX_DISTANCE] is not None:
+            max_distance = self.parameterAsDouble(parameters, self.MAX_DISTANCE, context)
+        else:
+            max_distance = 0
+
         distance_field = QgsField("distance_closest", QVariant.Double)
+        rank_field = QgsField("rank_closest", QVariant.Int)
 
         all_fields = QgsFields()
 
         all_fields.append(id_field_closest_geometry)
         all_fields.append(id_field_input_points)
         all_fields.append(distance_field)
+        all_fields.append(rank_field)
 
         (sink, sink_dest) = self.parameterAsSink(parameters, self.OUTPUT, context, all_fields,
                                                  QgsWkbTypes.LineString, input_points.sourceCrs())
 
-        total = 100.0 / (input_points.featureCount() * closest_layer.featureCount()
-                        ) if input_points.featureCount() and closest_layer.featureCount() else 0
+        engine = self.parameterAsEnum(parameters, self.ENGINE, context)
 
-        start_feature: QgsFeature
-        closest_geom_feature: QgsFeature
+        if engine == 1:
 
-        for start_feature_count, start_feature in enumerate(input_points.getFeatures()):
+            if not numpy_available:
+                raise QgsProcessingException(
+                    self.tr('NumPy engine requires numpy Python package to be installed.'))
 
-            smallest_distance = sys.float_info.max
+            closest_index = NumpyNearestGeometryIndex(closest_layer, id_field_name,
+                                                      crs_transformer, feedback)
 
-            result_geom = None
+        else:
 
-            for closest_geom_count, closest_geom_feature in enumerate(closest_layer.getFeatures()):
+            closest_index = NearestGeometryIndex(closest_layer, id_field_name, crs_transformer,
+                                                 feedback)
 
-                if feedback.isCanceled():
-                    break
+        threads = self.parameterAsInt(parameters, self.THREADS, context)
+
+        total = 100.0 / input_points.featureCount() if input_points.featureCount() else 0
 
-                result_feature = QgsFeature(all_fields)
+        # every worker thread queries its own index, prepared geometries are shared
+        worker_data = threading.local()
+
+        def process_chunk(start_features: List[QgsFeature]) -> List[QgsFeature]:
+
+            if not hasattr(worker_data, 'index'):
+                worker_data.index = closest_index.view()
+
+            result_features = []
+
+            points = []
+
+            start_feature: QgsFeature
+
+            for start_feature in start_features:
 
                 point_geom = start_feature.geometry()
 
-                closest_geom = closest_geom_feature.geometry()
+                points.append(QgsPoint(point_geom.asPoint().x(), point_geom.asPoint().y()))
+
+            # whole chunk is searched at once, so that the engine can process it in batches
+            closest_all = worker_data.index.nearest_many(points, k, max_distance)
+
+            for start_feature, point, closest in zip(start_features, points, closest_all):
+
+                for rank, (closest_position, distance, closest_point) in enumerate(closest, 1):
+
+                    result_feature = QgsFeature(all_fields)
+
+                    result_feature.setGeometry(QgsLineString([point, closest_point]))
 
-                if crs_transformer:
-                    closest_geom.transform(crs_transformer)
+                    result_feature.setAttribute(
+                        all_fields.lookupField(id_field_name_input_points),
+                        start_feature.attribute(id_field_name_input_points))
+                    result_feature.setAttribute(all_fields.lookupField(id_field_name),
+                                                closest_index.targets.ids[closest_position])
+                    result_feature.setAttribute(all_fields.lookupField(distance_field.name()),
+                                                distance)
+                    result_feature.setAttribute(all_fields.lookupField(rank_field.name()), rank)
 
-                distance_bbox = closest_geom.boundingBox().distance(point_geom.asPoint())
+                    result_features.append(result_feature)
 
-                if distance_bbox < smallest_distance:
+            return result_features
 
-                    geom_to_check = geometry_to_abstractgeometry(closest_geom)
+        processed = 0
 
-                    point = QgsPoint(point_geom.asPoint().x(), point_geom.asPoint().y())
+        pending: Deque[Tuple[Future, int]] = deque()
 
-                    if isinstance(geom_to_check, QgsPoint):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
 
-                        closest_point = geom_to_check
+            for chunk in feature_chunks(input_points.getFeatures(), self.CHUNK_SIZE):
 
-                    else:
+                if feedback.isCanceled():
+                    break
+
+                pending.append((executor.submit(process_chunk, chunk), len(chunk)))
 
-                        closest_point = QgsGeometryUtils.closestPoint(geom_to_check, point)
+                # results are written in input order, only a few chunks are kept in memory
+                while pending and (len(pending) > 2 * threads or pending[0][0].done()):
 
-                    distance = point.distance(closest_point)
+                    future, chunk_size = pending.popleft()
 
-                    if distance < smallest_distance:
+                    sink.addFeatures(future.result(), QgsFeatureSink.FastInsert)
 
-                        result_geom = QgsLineString([point, closest_point])
+                    processed += chunk_size
+                    feedback.setProgress(int(processed * total))
 
-                        smallest_distance = distance
+            while pending:
 
-            feedback.setProgress(int((start_feature_count * closest_geom_count) * total))
+                future, chunk_size = pending.popleft()
 
-            if result_geom:
-                result_feature.setGeometry(result_geom)
+                if feedback.isCanceled():
+                    future.cancel()
+                    continue
 
-            result_feature.setAttribute(all_fields.lookupField(id_field_name_input_points),
-                                        start_feature.attribute(id_field_name_input_points))
-            result_feature.setAttribute(all_fields.lookupField(id_field_name),
-                                        closest_geom_feature.attribute(id_field_name))
-            result_feature.setAttribute(all_fields.lookupField(distance_field.name()),
-                                        smallest_distance)
+                sink.addFeatures(future.result(), QgsFeatureSink.FastInsert)
 
-            sink.addFeature(result_feature)
+                processed += chunk_size
+                feedback.setProgress(int(processed * total))
 
         return {self.OUTPUT: sink_dest}
 
@@ -167,30 +285,481 @@ class ClosestGeometryAlgorithm(QgsProcessingAlgorithm):
         return QCoreApplication.translate('Processing', string)
 
 
-def geometry_to_abstractgeometry(geom: QgsGeometry) -> QgsAbstractGeometry:
+def feature_chunks(features: Iterable[QgsFeature], size: int) -> Iterator[List[QgsFeature]]:
+
+    features = iter(features)
+
+    while True:
+
+        chunk = list(islice(features, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+class PreparedGeometries:
+
+    # approximate size of decoded geometries kept in memory, the rest is written as WKB to a
+    # temporary file, reading it back is a slow fallback for layers that do not fit in memory
+    MEMORY_LIMIT = 512 * 1024 * 1024
+
+    # approximate size of geometries read back from the temporary file and kept decoded
+    SPILLED_CACHE_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, memory_limit: int = MEMORY_LIMIT):
+
+        self.memory_limit = memory_limit
+        self.memory_used = 0
+
+        self.ids: List[Any] = []
+        self.bboxes = array('d')
+        self.geometries: List[Optional[QgsAbstractGeometry]] = []
+
+        # offset and size of WKB in the temporary file, -1 for geometries kept in memory
+        self.spilled_offsets = array('q')
+        self.spilled_sizes = array('q')
+        self.spill_file = None
+
+        self.spilled_cache: 'OrderedDict[int, QgsAbstractGeometry]' = OrderedDict()
+        self.spilled_cache_size = 0
+        self.spill_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def append(self, geom: QgsGeometry, id_value: Any) -> int:
+
+        position = len(self.ids)
+
+        abstract_geom = geom.constGet().clone()
+
+        # calculates and caches the bounding box of the geometry
+        bbox = abstract_geom.boundingBox()
+
+        self.ids.append(id_value)
+        self.bboxes.extend([bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()])
+
+        size = abstract_geom.wkbSize()
+
+        if self.memory_used + size <= self.memory_limit:
+            self.geometries.append(abstract_geom)
+            self.spilled_offsets.append(-1)
+            self.spilled_sizes.append(0)
+            self.memory_used += size
+        else:
+            if self.spill_file is None:
+                self.spill_file = tempfile.TemporaryFile(dir=QgsProcessingUtils.tempFolder())
+
+            self.spill_file.seek(0, 2)
+            self.spilled_offsets.append(self.spill_file.tell())
+            self.spilled_sizes.append(size)
+            self.spill_file.write(bytes(abstract_geom.asWkb()))
+            self.geometries.append(None)
+
+        return position
+
+    def geometry(self, position: int) -> QgsAbstractGeometry:
+
+        abstract_geom = self.geometries[position]
+
+        if abstract_geom is not None:
+            return abstract_geom
+
+        # recently used geometries from the temporary file are kept decoded, neighbouring points
+        # mostly query the same targets
+        with self.spill_lock:
+
+            if position in self.spilled_cache:
+                self.spilled_cache.move_to_end(position)
+                return self.spilled_cache[position]
+
+            self.spill_file.seek(self.spilled_offsets[position])
+            wkb = self.spill_file.read(self.spilled_sizes[position])
+
+            geom = QgsGeometry()
+            geom.fromWkb(wkb)
+            abstract_geom = geom.constGet().clone()
+
+            self.spilled_cache[position] = abstract_geom
+            self.spilled_cache_size += len(wkb)
+
+            while (self.spilled_cache_size > self.SPILLED_CACHE_LIMIT and
+                   len(self.spilled_cache) > 1):
+                evicted_position, _ = self.spilled_cache.popitem(last=False)
+                self.spilled_cache_size -= self.spilled_sizes[evicted_position]
+
+        return abstract_geom
+
+    def bbox(self, position: int) -> QgsRectangle:
+        return QgsRectangle(*self.bboxes[position * 4:position * 4 + 4])
+
+
+class NearestGeometryIndex:
+
+    # number of bounding boxes added to the memory layer at once
+    BBOX_BATCH = 10000
+
+    def __init__(self,
+                 source: QgsFeatureSource,
+                 id_field_name: str,
+                 crs_transformer: QgsCoordinateTransform = None,
+                 feedback: QgsProcessingFeedback = None):
+
+        self.targets = PreparedGeometries()
+
+        # bounding boxes are kept as diagonals in a memory layer, so that every index is bulk
+        # loaded (STR) from it, memory provider numbers features from 1 in the order of adding
+        bbox_layer = QgsMemoryProviderUtils.createMemoryLayer(
+            'bboxes', QgsFields(), QgsWkbTypes.LineString, QgsCoordinateReferenceSystem())
+        bbox_features = []
+
+        request = QgsFeatureRequest().setSubsetOfAttributes([id_field_name], source.fields())
+
+        feature: QgsFeature
+
+        # target layer is read, transformed and decoded only once, all queries go through index
+        for feature in source.getFeatures(request):
+
+            if feedback and feedback.isCanceled():
+                break
+
+            if not feature.hasGeometry() or feature.geometry().isEmpty():
+                continue
+
+            geom = feature.geometry()
+
+            if crs_transformer:
+                geom.transform(crs_transformer)
+
+            position = self.targets.append(geom, feature.attribute(id_field_name))
+
+            bbox_features.append(self.bbox_feature(position))
+
+            if len(bbox_features) >= self.BBOX_BATCH:
+                bbox_layer.dataProvider().addFeatures(bbox_features)
+                bbox_features = []
+
+        bbox_layer.dataProvider().addFeatures(bbox_features)
+
+        # feature source of the provider can be iterated from any thread
+        self.bbox_source = bbox_layer.dataProvider().featureSource()
+
+        self.index = self.build_index(feedback)
+
+        self.index_in_use = False
+        self.view_lock = threading.Lock()
+
+    def bbox_feature(self, position: int) -> QgsFeature:
+
+        bbox = self.targets.bbox(position)
+
+        feature = QgsFeature()
+        feature.setGeometry(
+            QgsGeometry(
+                QgsLineString([
+                    QgsPoint(bbox.xMinimum(), bbox.yMinimum()),
+                    QgsPoint(bbox.xMaximum(), bbox.yMaximum())
+                ])))
+
+        return feature
+
+    def build_index(self, feedback: QgsProcessingFeedback = None) -> QgsSpatialIndex:
+
+        request = QgsFeatureRequest().setNoAttributes()
+
+        return QgsSpatialIndex(self.bbox_source.getFeatures(request), feedback)
+
+    def view(self) -> 'NearestGeometryIndex':
+
+        # index for use from other thread, prepared geometries are only read, the first view
+        # uses the index built with the targets, copies of QgsSpatialIndex share data and a
+        # lock, so every other view bulk loads its own index
+        with self.view_lock:
+
+            if not self.index_in_use:
+                self.index_in_use = True
+                return self
+
+        index_view = copy.copy(self)
+        index_view.index = self.build_index()
+
+        return index_view
+
+    def candidates(self, point: QgsPointXY, neighbors: int, max_distance: float) -> List[int]:
+
+        return [fid - 1 for fid in self.index.nearestNeighbor(point, neighbors, max_distance)]
+
+    def nearest(self,
+                point: QgsPoint,
+                k: int = 1,
+                max_distance: float = 0) -> List[Tuple[int, float, QgsPoint]]:
+
+        return self.nearest_many([point], k, max_distance)[0]
+
+    def nearest_many(self,
+                     points: List[QgsPoint],
+                     k: int = 1,
+                     max_distance: float = 0) -> List[List[Tuple[int, float, QgsPoint]]]:
+
+        points_xy = [QgsPointXY(point.x(), point.y()) for point in points]
+
+        measured: List[Dict[int, Tuple[float, QgsPoint]]] = [{} for _ in points]
+        results: List[List[Tuple[int, Tuple[float, QgsPoint]]]] = [[] for _ in points]
+
+        active = list(range(len(points)))
+
+        neighbors = k
+
+        while active:
+
+            pairs: List[Tuple[int, int]] = []
+            candidates_count: Dict[int, int] = {}
+            bbox_distances: Dict[int, float] = {}
+
+            for i in active:
+
+                # with maximum distance set, targets whose bounding box is farther are never
+                # returned
+                candidates = self.candidates(points_xy[i], neighbors, max_distance)
+
+                candidates_count[i] = len(candidates)
+
+                bbox_distance = 0
+
+                for position in candidates:
+
+                    bbox_distance = max(bbox_distance,
+                                        self.targets.bbox(position).distance(points_xy[i]))
+
+                    if position not in measured[i]:
+                        pairs.append((i, position))
+
+                bbox_distances[i] = bbox_distance
+
+            for (i, position), measurement in zip(pairs, self.measure(points, pairs)):
+                measured[i][position] = measurement
+
+            still_active = []
+
+            for i in active:
+
+                result = [
+                    item for item in measured[i].items()
+                    if not max_distance or item[1][0] <= max_distance
+                ]
+                results[i] = sorted(result, key=lambda item: item[1][0])[:k]
+
+                if candidates_count[i] < neighbors:
+                    continue
+
+                # bounding box distance is a lower bound of the exact distance, so once the
+                # farthest candidate box is not closer than the k-th exact distance no other
+                # target can win
+                if len(results[i]) == k and results[i][-1][1][0] <= bbox_distances[i]:
+                    continue
+
+                still_active.append(i)
+
+            active = still_active
+
+            neighbors *= 2
+
+        return [[(position, distance, closest_point)
+                 for position, (distance, closest_point) in result]
+                for result in results]
+
+    def measure(self, points: List[QgsPoint],
+                pairs: List[Tuple[int, int]]) -> List[Tuple[float, QgsPoint]]:
+
+        return [self.closest_point(position, points[i]) for i, position in pairs]
+
+    def closest_point(self, position: int, point: QgsPoint) -> Tuple[float, QgsPoint]:
+
+        geom_to_check = self.targets.geometry(position)
+
+        if isinstance(geom_to_check, QgsPoint):
+
+            closest_point = geom_to_check
+
+        else:
+
+            closest_point = QgsGeometryUtils.closestPoint(geom_to_check, point)
+
+        return point.distance(closest_point), closest_point
+
+
+class NumpyNearestGeometryIndex(NearestGeometryIndex):
+
+    VECTORIZED_TYPES = [
+        QgsWkbTypes.Point, QgsWkbTypes.MultiPoint, QgsWkbTypes.LineString,
+        QgsWkbTypes.MultiLineString, QgsWkbTypes.Polygon, QgsWkbTypes.MultiPolygon
+    ]
+
+    # tolerances used by QgsGeometryUtils, so that the results are identical
+    DOUBLE_NEAR = 4 * sys.float_info.epsilon
+    SEGMENT_EPSILON = 1e-8
+
+    # number of segments processed at once, every segment needs about 20 float64 temporaries
+    BATCH_SEGMENTS = 1000000
+
+    def __init__(self,
+                 source: QgsFeatureSource,
+                 id_field_name: str,
+                 crs_transformer: QgsCoordinateTransform = None,
+                 feedback: QgsProcessingFeedback = None):
+
+        super().__init__(source, id_field_name, crs_transformer, feedback)
+
+        x1, y1, x2, y2 = array('d'), array('d'), array('d'), array('d')
+        offsets = array('q', [0])
+
+        # segments of every target stored in contiguous arrays, points as zero length segments,
+        # curved and other geometries have no segments and use QgsGeometryUtils
+        for position in range(len(self.targets)):
+
+            geom = self.targets.geometry(position)
+
+            if QgsWkbTypes.flatType(geom.wkbType()) in self.VECTORIZED_TYPES:
+
+                for part in geom.coordinateSequence():
+
+                    for ring in part:
+
+                        coords = [(vertex.x(), vertex.y()) for vertex in ring]
+
+                        if len(coords) == 1:
+                            coords = coords * 2
+
+                        for (start_x, start_y), (end_x, end_y) in zip(coords[:-1], coords[1:]):
+                            x1.append(start_x)
+                            y1.append(start_y)
+                            x2.append(end_x)
+                            y2.append(end_y)
+
+            offsets.append(len(x1))
+
+        self.x1 = np.array(x1, dtype=np.float64)
+        self.y1 = np.array(y1, dtype=np.float64)
+        self.x2 = np.array(x2, dtype=np.float64)
+        self.y2 = np.array(y2, dtype=np.float64)
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+        self.vectorized = np.diff(self.offsets) > 0
+
+    def measure(self, points: List[QgsPoint],
+                pairs: List[Tuple[int, int]]) -> List[Tuple[float, QgsPoint]]:
+
+        measurements: List[Optional[Tuple[float, QgsPoint]]] = [None] * len(pairs)
+
+        vectorized = []
+
+        for j, (i, position) in enumerate(pairs):
+
+            if self.vectorized[position]:
+                vectorized.append(j)
+            else:
+                measurements[j] = self.closest_point(position, points[i])
+
+        for batch in self.segment_batches(pairs, vectorized):
+
+            pairs_x = np.array([points[pairs[j][0]].x() for j in batch], dtype=np.float64)
+            pairs_y = np.array([points[pairs[j][0]].y() for j in batch], dtype=np.float64)
+            pairs_targets = np.array([pairs[j][1] for j in batch], dtype=np.int64)
+
+            distances, closest_x, closest_y = self.closest_points(pairs_x, pairs_y,
+                                                                  pairs_targets)
+
+            for j, distance, x, y in zip(batch, distances.tolist(), closest_x.tolist(),
+                                         closest_y.tolist()):
+                measurements[j] = (distance, QgsPoint(x, y))
+
+        return measurements
+
+    def segment_batches(self, pairs: List[Tuple[int, int]],
+                        vectorized: List[int]) -> Iterator[List[int]]:
+
+        # pairs are split so that temporaries of one batch stay bounded, target with more
+        # segments than the limit forms a batch of its own
+        batch = []
+        batch_segments = 0
+
+        for j in vectorized:
+
+            position = pairs[j][1]
+            segments = int(self.offsets[position + 1] - self.offsets[position])
+
+            if batch and batch_segments + segments > self.BATCH_SEGMENTS:
+                yield batch
+                batch = []
+                batch_segments = 0
+
+            batch.append(j)
+            batch_segments += segments
+
+        if batch:
+            yield batch
+
+    def closest_points(self, points_x: 'np.ndarray', points_y: 'np.ndarray',
+                       targets: 'np.ndarray') -> Tuple['np.ndarray', 'np.ndarray', 'np.ndarray']:
+
+        starts = self.offsets[targets]
+        counts = self.offsets[targets + 1] - starts
+
+        # every pair of point and target is expanded to all segments of the target
+        group_starts = np.cumsum(counts) - counts
+        segments = (np.arange(counts.sum()) - np.repeat(group_starts, counts) +
+                    np.repeat(starts, counts))
+
+        px = np.repeat(points_x, counts)
+        py = np.repeat(points_y, counts)
+
+        x1 = self.x1[segments]
+        y1 = self.y1[segments]
+        x2 = self.x2[segments]
+        y2 = self.y2[segments]
+
+        dx = x2 - x1
+        dy = y2 - y1
+
+        # same calculation as QgsGeometryUtils.sqrDistToLine
+        degenerate = (np.abs(dx) <= self.DOUBLE_NEAR) & (np.abs(dy) <= self.DOUBLE_NEAR)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = ((px - x1) * dx + (py - y1) * dy) / (dx * dx + dy * dy)
+
+        t[degenerate] = 0
+
+        cx = np.where(t > 1, x2, np.where(t > 0, x1 + dx * t, x1))
+        cy = np.where(t > 1, y2, np.where(t > 0, y1 + dy * t, y1))
+
+        sqr_distance = (cx - px) * (cx - px) + (cy - py) * (cy - py)
+
+        on_segment = sqr_distance <= self.SEGMENT_EPSILON
+
+        cx = np.where(on_segment, px, cx)
+        cy = np.where(on_segment, py, cy)
+        sqr_distance[on_segment] = 0
 
-    if geom.wkbType() == QgsWkbTypes.Polygon:
-        geom_to_check = QgsPolygon()
-        geom_to_check.fromWkt(geom.asWkt())
+        # first segment with the smallest distance for every pair, as in closestSegment
+        order = np.lexsort((sqr_distance, np.repeat(np.arange(len(targets)), counts)))
+        best = order[group_starts]
 
-    if geom.wkbType() == QgsWkbTypes.MultiPolygon:
-        geom_to_check = QgsMultiPolygon()
-        geom_to_check.fromWkt(geom.asWkt())
+        px, py = px[best], py[best]
+        x1, y1, x2, y2 = x1[best], y1[best], x2[best], y2[best]
+        cx, cy = cx[best], cy[best]
 
-    if geom.wkbType() == QgsWkbTypes.LineString:
-        geom_to_check = QgsLineString()
-        geom_to_check.fromWkt(geom.asWkt())
+        # snapping to segment vertices done by QgsGeometryUtils.closestPoint
+        length = np.sqrt((x1 - x2) * (x1 - x2) + (y1 - y2) * (y1 - y2))
+        distance_before = np.sqrt((x1 - cx) * (x1 - cx) + (y1 - cy) * (y1 - cy))
 
-    if geom.wkbType() == QgsWkbTypes.MultiLineString:
-        geom_to_check = QgsMultiLineString()
-        geom_to_check.fromWkt(geom.asWkt())
+        snap_before = np.abs(distance_before) <= self.DOUBLE_NEAR
+        snap_after = ~snap_before & (np.abs(distance_before - length) <= self.DOUBLE_NEAR)
 
-    if geom.wkbType() == QgsWkbTypes.Point:
-        geom_to_check = QgsPoint()
-        geom_to_check.fromWkt(geom.asWkt())
+        cx = np.where(snap_before, x1, np.where(snap_after, x2, cx))
+        cy = np.where(snap_before, y1, np.where(snap_after, y2, cy))
 
-    if geom.wkbType() == QgsWkbTypes.MultiPoint:
-        geom_to_check = QgsMultiPoint()
-        geom_to_check.fromWkt(geom.asWkt())
+        distances = np.sqrt((px - cx) * (px - cx) + (py - cy) * (py - cy))
 
-    return geom_to_check
+        return distances, cx, cy
@@ -1,8 +1,22 @@
+import base64
+import hashlib
+import http.client
 import json
+import os
+import shutil
+import socket
+import struct
 import tempfile
-import urllib
+import threading
+import time
+import urllib.parse
+import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from pathlib import Path
-from zipfile import ZipFile
+from typing import BinaryIO, Callable, Dict, List, Optional, Set, Tuple, TypeVar
+from zipfile import BadZipFile, ZipFile
 
 point_cloud_layer = True
 try:
@@ -11,16 +25,24 @@ except:
     point_cloud_layer = False
 
 import processing
+from qgis.PyQt.QtCore import QStandardPaths
 from qgis.core import (
     QgsCoordinateReferenceSystem,
+    QgsGeometry,
+    QgsPointXY,
     QgsProcessingAlgorithm,
     QgsProcessingException,
+    QgsProcessingFeedback,
     QgsProcessingOutputPointCloudLayer,
     QgsProcessingParameterBoolean,
     QgsProcessingParameterEnum,
     QgsProcessingParameterExtent,
+    QgsProcessingParameterDefinition,
     QgsProcessingParameterFolderDestination,
+    QgsProcessingParameterNumber,
     QgsProject,
+    QgsRectangle,
+    QgsSpatialIndex,
 )
 
 
@@ -30,6 +52,10 @@ class DownloadCuzkElevationData(QgsProcessingAlgorithm):
     DATA_TYPE = "DATA_TYPE"
     LOAD_LAYERS = "LOAD_LAYERS"
     VPC_LYR = "VPC_LYR"
+    CONCURRENCY = "CONCURRENCY"
+    CACHE_SIZE = "CACHE_SIZE"
+    STREAM_EXTRACT = "STREAM_EXTRACT"
+    INDEX_MAX_AGE = "INDEX_MAX_AGE"
 
     DATA_TYPES = ["DMP1G", "DMR5G", "DMR4G"]
 
@@ -62,6 +88,45 @@ class DownloadCuzkElevationData(QgsProcessingAlgorithm):
 
         self.addParameter(QgsProcessingParameterBoolean(self.LOAD_LAYERS, "Load Layers?", defaultValue=False))
 
+        concurrency_param = QgsProcessingParameterNumber(
+            self.CONCURRENCY,
+            "Number of parallel downloads",
+            type=QgsProcessingParameterNumber.Integer,
+            minValue=1,
+            maxValue=16,
+            defaultValue=4,
+        )
+        concurrency_param.setFlags(concurrency_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(concurrency_param)
+
+        cache_size_param = QgsProcessingParameterNumber(
+            self.CACHE_SIZE,
+            "Size of downloaded tiles cache (MB, 0 disables caching)",
+            type=QgsProcessingParameterNumber.Integer,
+            minValue=0,
+            defaultValue=0,
+        )
+        cache_size_param.setFlags(cache_size_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(cache_size_param)
+
+        stream_extract_param = QgsProcessingParameterBoolean(
+            self.STREAM_EXTRACT,
+            "Extract tiles while downloading (no temporary files, not cached nor resumable)",
+            defaultValue=False,
+        )
+        stream_extract_param.setFlags(stream_extract_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(stream_extract_param)
+
+        index_max_age_param = QgsProcessingParameterNumber(
+            self.INDEX_MAX_AGE,
+            "Refresh cached tile index after (days, 0 queries the service on every run)",
+            type=QgsProcessingParameterNumber.Double,
+            minValue=0,
+            defaultValue=7,
+        )
+        index_max_age_param.setFlags(index_max_age_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(index_max_age_param)
+
         self.addParameter(QgsProcessingParameterFolderDestination(self.OUTPUT, "Output destination"))
 
         self.addOutput(QgsProcessingOutputPointCloudLayer(self.VPC_LYR, "Virtual Point Cloud"))
@@ -81,54 +146,162 @@ class DownloadCuzkElevationData(QgsProcessingAlgorithm):
 
         load_layers = self.parameterAsBool(parameters, self.LOAD_LAYERS, context)
 
-        url = f"https://atom.cuzk.cz/get.ashx?format=json&title=&theme={data_to_download}-SJTSK&crs=JTSK&bbox={bbox}"
+        concurrency = self.parameterAsInt(parameters, self.CONCURRENCY, context)
+
+        cache_size = self.parameterAsInt(parameters, self.CACHE_SIZE, context)
+
+        stream_extract = self.parameterAsBool(parameters, self.STREAM_EXTRACT, context)
+
+        index_max_age = self.parameterAsDouble(parameters, self.INDEX_MAX_AGE, context) * 24 * 60 * 60
+
+        Path(out_folder).mkdir(parents=True, exist_ok=True)
+        manifest = TileManifest(Path(out_folder))
+
+        # tile id together with its last update identifies the content of the tile, footprint is in WGS 84
+        tiles = []
+
+        if manifest.covers(extent_wgs84, data_to_download):
+            feedback.pushInfo("Extent is covered by tiles already present in output folder.")
+        else:
+            tile_index = None
+            if index_max_age > 0:
+                index_folder = cache_folder() / "cuzk_atom"
+                index_path = index_folder / f"{data_to_download}.json"
+                tile_index = TileIndex.load(index_path, data_to_download, index_max_age, feedback)
 
-        response = urllib.request.urlopen(url)
-        data_json = json.loads(response.read())
+            if tile_index is not None:
+                tiles = tile_index.tiles(extent_wgs84)
 
-        urls = []
-        if "entry" in data_json.keys():
-            for i in range(len(data_json["entry"])):
-                urls.append(data_json["entry"][i]["id"])
+                # tiles missing in the index (new or without footprint) are still found by the service
+                if not tiles:
+                    feedback.pushInfo("No tiles found in tile index for extent, querying service.")
+
+            if not tiles:
+                tiles = feed_tiles(atom_feed(data_to_download, bbox))
 
         temp_download_dir = Path(tempfile.gettempdir()) / "cuzk_data"
         temp_download_dir.mkdir(parents=True, exist_ok=True)
 
-        for i, link in enumerate(urls):
-            if feedback.isCanceled():
-                break
+        cache = None
+        if cache_size > 0:
+            cache = TileCache(cache_folder() / "cuzk_tiles", cache_size)
+
+        downloader = TileDownloader()
 
+        # every worker extracts its tile right after download, while other tiles are still downloading
+        def download_tile(link: str, updated: str) -> List[str]:
             path = Path(link)
-            temp_path = temp_download_dir / path.name
-            urllib.request.urlretrieve(link, temp_path)
 
-            with ZipFile(temp_path, "r") as zipFile:
-                zipFile.extractall(path=out_folder)
+            zip_path = cache.get(link, updated) if cache else None
+
+            if zip_path is None and stream_extract:
+                return downloader.stream(
+                    link, lambda response: stream_point_clouds(response, Path(out_folder)), feedback
+                )
+
+            used_paths = []
+
+            try:
+                # corrupted archive (downloaded or cached) is deleted and downloaded once more
+                for attempt in range(2):
+                    if zip_path is None:
+                        # partially downloaded file is kept under a stable name, so an interrupted run can resume it
+                        if cache:
+                            part_path = cache.part_path(link, updated)
+                        else:
+                            part_path = temp_download_dir / f"{tile_key(link, updated)}.part"
+
+                        used_paths.append(part_path)
+                        downloader.download(link, part_path, feedback)
+
+                        zip_path = cache.put(link, updated, part_path) if cache else part_path
+                    else:
+                        feedback.pushInfo(f"Using cached tile {path.name}.")
+
+                    used_paths.append(zip_path)
+
+                    try:
+                        # CRC of members is checked while they are extracted
+                        files = extract_point_clouds(zip_path, Path(out_folder))
+                    except (BadZipFile, zlib.error, EOFError) as e:
+                        zip_path.unlink()
+                        zip_path = None
+
+                        if attempt == 1:
+                            raise QgsProcessingException(f"Downloaded tile {path.name} is corrupted: {e}")
+
+                        feedback.pushWarning(f"Tile {path.name} is corrupted, downloading it again: {e}")
+                        continue
+
+                    if not cache:
+                        zip_path.unlink()
 
-            temp_path.unlink()
+                    return files
 
-            feedback.setProgress((i / len(urls)) * 100)
+            finally:
+                if cache:
+                    for used_path in used_paths:
+                        cache.release(used_path)
 
-        if point_cloud_layer and load_layers:
+        # tiles extracted by previous (possibly interrupted) runs are skipped
+        missing_tiles = [tile for tile in tiles if not manifest.is_complete(tile[0], tile[1])]
+
+        for link, updated, footprint in tiles:
+            if manifest.is_complete(link, updated):
+                manifest.set_footprint(link, footprint)
+
+        if len(missing_tiles) < len(tiles):
+            feedback.pushInfo(f"{len(tiles) - len(missing_tiles)} tiles already present in output folder.")
+
+        extracted_files = set()
+
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = {
+                    executor.submit(download_tile, link, updated): (link, updated, footprint)
+                    for link, updated, footprint in missing_tiles
+                }
+
+                for i, future in enumerate(as_completed(futures)):
+                    if feedback.isCanceled():
+                        for not_done in futures:
+                            not_done.cancel()
+                        break
+
+                    link, updated, footprint = futures[future]
+                    files = future.result()
+                    manifest.add(link, updated, data_to_download, files, footprint)
+                    extracted_files.update(files)
+
+                    feedback.setProgress(((i + 1) / len(missing_tiles)) * 100)
+
+        finally:
+            # cache is trimmed also when some tile failed
+            if cache:
+                cache.evict()
+
+        if point_cloud_layer and load_layers and manifest.files():
             # crs = QgsCoordinateReferenceSystem("ESPG:5514")
             path = Path(out_folder)
 
             result_vpc_path = path / "all.vpc"
 
-            layers = []
-            for file in path.iterdir():
-                layers.append(file.as_posix())
-
-            result = processing.run(
-                "pdal:virtualpointcloud",
-                {
-                    "LAYERS": layers,
-                    "BOUNDARY": False,
-                    "STATISTICS": False,
-                    "OVERVIEW": False,
-                    "OUTPUT": result_vpc_path.as_posix(),  # "TEMPORARY_OUTPUT",
-                },
-            )
+            # only files that were added or replaced since the virtual point cloud was last built are processed
+            files = manifest.files()
+            changed_files = (files - manifest.vpc_files) | (extracted_files & files)
+            removed_files = manifest.vpc_files - files
+
+            if not result_vpc_path.exists() or removed_files or not virtual_point_cloud_valid(result_vpc_path):
+                build_virtual_point_cloud(path, files, result_vpc_path)
+            elif changed_files:
+                changed_vpc_path = path / "changed.vpc"
+                build_virtual_point_cloud(path, changed_files, changed_vpc_path)
+                merge_virtual_point_clouds(result_vpc_path, changed_vpc_path)
+                changed_vpc_path.unlink()
+            else:
+                feedback.pushInfo("Virtual point cloud is up to date.")
+
+            manifest.set_vpc_files(files)
 
             # result = processing.run(
             #     "pdal:assignprojection",
@@ -139,6 +312,703 @@ class DownloadCuzkElevationData(QgsProcessingAlgorithm):
             #     },
             # )
 
-            return {self.OUTPUT: out_folder, self.VPC_LYR: result["OUTPUT"]}
+            return {self.OUTPUT: out_folder, self.VPC_LYR: result_vpc_path.as_posix()}
 
         return {self.OUTPUT: out_folder}
+
+
+POINT_CLOUD_SUFFIXES = (".las", ".laz")
+
+# tolerance in degrees (about 1 cm) used when joining tile footprints
+FOOTPRINT_TOLERANCE = 1e-7
+
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+ZIP_LOCAL_HEADER_SIGNATURE = 0x04034B50
+ZIP_DATA_DESCRIPTOR_SIGNATURE = 0x08074B50
+
+T = TypeVar("T")
+
+
+def cache_folder() -> Path:
+    # local cache location of the system, unlike the profile folder it is not part of roaming profile on Windows
+    return Path(QStandardPaths.writableLocation(QStandardPaths.CacheLocation))
+
+
+def is_point_cloud(file_name: str) -> bool:
+    return file_name.lower().endswith(POINT_CLOUD_SUFFIXES)
+
+
+def extract_point_clouds(zip_path: Path, folder: Path) -> List[str]:
+    # other members of the archive (metadata etc.) are not extracted
+    with ZipFile(zip_path, "r") as zipFile:
+        members = [info for info in zipFile.infolist() if not info.is_dir() and is_point_cloud(info.filename)]
+
+        for member in members:
+            try:
+                zipFile.extract(member, path=folder)
+            except (BadZipFile, zlib.error, EOFError):
+                # partially extracted file of corrupted member is not left in the folder
+                target = member_path(folder, member.filename)
+                if target is not None and target.exists():
+                    target.unlink()
+                raise
+
+    return [member.filename for member in members]
+
+
+class ZipStream:
+    # sequential reader of ZIP archive from non seekable stream, data read beyond member end can be returned back
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.buffer = b""
+
+    def read(self, size: int) -> bytes:
+        if self.buffer:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+            return data
+
+        return self.stream.read(size)
+
+    def read_exact(self, size: int) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = self.read(size - len(data))
+            if not chunk:
+                raise QgsProcessingException("Unexpected end of ZIP archive.")
+            data += chunk
+        return data
+
+    def unread(self, data: bytes) -> None:
+        self.buffer = data + self.buffer
+
+
+def zip64_sizes(extra: bytes, compressed_size: int, size: int) -> Tuple[int, int]:
+    while len(extra) >= 4:
+        header_id, data_size = struct.unpack("<HH", extra[:4])
+        data = extra[4 : 4 + data_size]
+
+        if header_id == 0x0001:
+            values = list(struct.unpack(f"<{len(data) // 8}Q", data[: len(data) // 8 * 8]))
+            if size == 0xFFFFFFFF and values:
+                size = values.pop(0)
+            if compressed_size == 0xFFFFFFFF and values:
+                compressed_size = values.pop(0)
+
+        extra = extra[4 + data_size :]
+
+    return compressed_size, size
+
+
+def member_path(folder: Path, name: str) -> Optional[Path]:
+    # members with absolute paths or leading outside of the folder are not extracted
+    parts = Path(name.replace("\\", "/")).parts
+    if not parts or Path(name).is_absolute() or ".." in parts:
+        return None
+    return folder.joinpath(*parts)
+
+
+def stream_point_clouds(stream: BinaryIO, folder: Path, chunk_size: int = 1024 * 1024) -> List[str]:
+    # members are read one by one from local file headers, central directory at the end of archive is not needed
+    archive = ZipStream(stream)
+    files = []
+
+    while True:
+        header = archive.read_exact(4)
+
+        if struct.unpack("<I", header)[0] != ZIP_LOCAL_HEADER_SIGNATURE:
+            # central directory reached, all members were read
+            return files
+
+        header += archive.read_exact(ZIP_LOCAL_HEADER.size - 4)
+        (_, _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length) = ZIP_LOCAL_HEADER.unpack(
+            header
+        )
+
+        name = archive.read_exact(name_length).decode("utf-8" if flags & 0x800 else "cp437")
+        zip64 = 0xFFFFFFFF in (compressed_size, size)
+        compressed_size, size = zip64_sizes(archive.read_exact(extra_length), compressed_size, size)
+
+        has_data_descriptor = bool(flags & 0x08)
+
+        if flags & 0x01:
+            raise QgsProcessingException(f"Encrypted ZIP member {name} is not supported.")
+        if method not in (0, 8) or (method == 0 and has_data_descriptor):
+            raise QgsProcessingException(f"ZIP member {name} can not be extracted while downloading.")
+
+        target = None
+        if not name.endswith("/") and is_point_cloud(name):
+            target = member_path(folder, name)
+
+        output = None
+        if target is not None:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            output = open(target.with_name(f"{target.name}.part"), "wb")
+
+        try:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == 8 else None
+            remaining = None if has_data_descriptor else compressed_size
+            member_crc = 0
+
+            while remaining is None or remaining > 0:
+                chunk = archive.read(chunk_size if remaining is None else min(chunk_size, remaining))
+                if not chunk:
+                    raise QgsProcessingException(f"Unexpected end of ZIP archive in member {name}.")
+
+                if remaining is not None:
+                    remaining -= len(chunk)
+
+                data = chunk
+                if decompressor:
+                    data = decompressor.decompress(chunk)
+
+                if output:
+                    member_crc = zlib.crc32(data, member_crc)
+                    output.write(data)
+
+                if decompressor and decompressor.eof:
+                    # size of member with data descriptor is known only after its end is decompressed
+                    archive.unread(decompressor.unused_data)
+                    break
+
+            if has_data_descriptor:
+                descriptor = archive.read_exact(4)
+                if struct.unpack("<I", descriptor)[0] == ZIP_DATA_DESCRIPTOR_SIGNATURE:
+                    descriptor = archive.read_exact(4)
+                crc = struct.unpack("<I", descriptor)[0]
+                # compressed and uncompressed sizes are not needed, member end is known from decompression
+                archive.read_exact(16 if zip64 else 8)
+
+        finally:
+            if output:
+                output.close()
+
+        if output:
+            if member_crc != crc:
+                target.with_name(f"{target.name}.part").unlink()
+                raise QgsProcessingException(f"CRC check of ZIP member {name} failed.")
+
+            os.replace(target.with_name(f"{target.name}.part"), target)
+            files.append(name)
+
+
+def tile_key(tile_id: str, updated: str) -> str:
+    return hashlib.sha1(f"{tile_id}|{updated}".encode("utf-8")).hexdigest()
+
+
+def content_range(header: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+    # start and total size from header in form "bytes 100-199/1000" or "bytes */1000"
+    if header is None or not header.startswith("bytes "):
+        return None, None
+
+    byte_range, _, total = header[len("bytes ") :].partition("/")
+
+    start = byte_range.partition("-")[0]
+
+    return (int(start) if start.isdigit() else None, int(total) if total.isdigit() else None)
+
+
+def atom_feed(data_type: str, bbox: Optional[str] = None) -> Dict:
+    # without bbox the feed lists all tiles of the data type
+    url = f"https://atom.cuzk.cz/get.ashx?format=json&title=&theme={data_type}-SJTSK&crs=JTSK"
+    if bbox:
+        url = f"{url}&bbox={bbox}"
+
+    response = urllib.request.urlopen(url)
+    return json.loads(response.read())
+
+
+def feed_tiles(data_json: Dict) -> List[Tuple[str, str, Optional[QgsGeometry]]]:
+    tiles = []
+    if "entry" in data_json.keys():
+        for entry in data_json["entry"]:
+            tiles.append((entry["id"], entry.get("updated", ""), entry_footprint(entry)))
+    return tiles
+
+
+def entry_footprint(entry: Dict) -> Optional[QgsGeometry]:
+    # WGS 84 footprint from bbox (lon lat order as in queries) or GeoRSS box / polygon (lat lon order)
+    for key, value in entry.items():
+        name = key.split(":")[-1].lower()
+
+        if name not in ("bbox", "box", "polygon"):
+            continue
+
+        try:
+            if isinstance(value, str):
+                values = [float(number) for number in value.replace(",", " ").split()]
+            else:
+                values = [float(number) for number in value]
+        except (TypeError, ValueError):
+            continue
+
+        if len(values) < 4 or len(values) % 2:
+            continue
+
+        if name == "bbox":
+            xs, ys = values[0::2], values[1::2]
+        else:
+            ys, xs = values[0::2], values[1::2]
+
+        # coordinates outside WGS 84 bounds (e.g. S-JTSK) would place the tile anywhere
+        if not all(-180 <= x <= 180 for x in xs) or not all(-90 <= y <= 90 for y in ys):
+            continue
+
+        if name == "polygon" and len(values) >= 6:
+            return QgsGeometry.fromPolygonXY([[QgsPointXY(x, y) for x, y in zip(xs, ys)]])
+
+        return QgsGeometry.fromRect(QgsRectangle(min(xs), min(ys), max(xs), max(ys)))
+
+    return None
+
+
+class TileIndex:
+    # tiles of one data type with their footprints, loaded indexes are kept in memory for following runs
+    loaded: Dict[str, Tuple[float, "TileIndex"]] = {}
+
+    def __init__(self, data_json: Dict):
+        self.tiles_list = []
+        self.footprints = []
+        self.index = QgsSpatialIndex()
+
+        for entry in data_json.get("entry", []):
+            footprint = entry_footprint(entry)
+            if footprint is None:
+                continue
+
+            self.index.addFeature(len(self.tiles_list), footprint.boundingBox())
+            self.tiles_list.append((entry["id"], entry.get("updated", "")))
+            self.footprints.append(footprint)
+
+    def tiles(self, extent: QgsRectangle) -> List[Tuple[str, str, QgsGeometry]]:
+        candidates = sorted(self.index.intersects(extent))
+        return [
+            (*self.tiles_list[i], self.footprints[i]) for i in candidates if self.footprints[i].intersects(extent)
+        ]
+
+    @classmethod
+    def load(
+        cls, path: Path, data_type: str, max_age: float, feedback: QgsProcessingFeedback
+    ) -> Optional["TileIndex"]:
+        # feed is downloaded again once it is older than max_age (seconds), old one is used if service is unavailable
+        if not path.exists() or time.time() - path.stat().st_mtime > max_age:
+            try:
+                data_json = atom_feed(data_type)
+            except (OSError, ValueError) as e:
+                feedback.pushWarning(f"Tile index of {data_type} could not be updated: {e}")
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                temp_path = path.with_name(f"{path.name}.part")
+                temp_path.write_text(json.dumps(data_json), encoding="utf-8")
+                os.replace(temp_path, path)
+
+        if not path.exists():
+            return None
+
+        mtime = path.stat().st_mtime
+        key = path.as_posix()
+
+        if key not in cls.loaded or cls.loaded[key][0] != mtime:
+            try:
+                cls.loaded[key] = (mtime, cls(json.loads(path.read_text(encoding="utf-8"))))
+            except (OSError, ValueError):
+                return None
+
+        tile_index = cls.loaded[key][1]
+
+        # feed without footprints can not be searched locally
+        if not tile_index.tiles_list:
+            feedback.pushInfo(f"Tile index of {data_type} has no tile footprints, querying service for extent.")
+            return None
+
+        return tile_index
+
+
+def build_virtual_point_cloud(folder: Path, files: Set[str], output: Path) -> None:
+    processing.run(
+        "pdal:virtualpointcloud",
+        {
+            "LAYERS": [(folder / file).as_posix() for file in sorted(files)],
+            "BOUNDARY": False,
+            "STATISTICS": False,
+            "OVERVIEW": False,
+            "OUTPUT": output.as_posix(),
+        },
+    )
+
+
+def virtual_point_cloud_valid(path: Path) -> bool:
+    try:
+        return isinstance(json.loads(path.read_text(encoding="utf-8")).get("features"), list)
+    except (OSError, ValueError, AttributeError):
+        return False
+
+
+def merge_virtual_point_clouds(vpc_path: Path, added_path: Path) -> None:
+    # features of replaced files are swapped for the new ones, both files are in the same folder so hrefs match
+    def href(feature: Dict) -> Optional[str]:
+        return feature.get("assets", {}).get("data", {}).get("href")
+
+    vpc = json.loads(vpc_path.read_text(encoding="utf-8"))
+    added = json.loads(added_path.read_text(encoding="utf-8"))
+
+    added_hrefs = {href(feature) for feature in added["features"]}
+
+    vpc["features"] = [feature for feature in vpc["features"] if href(feature) not in added_hrefs]
+    vpc["features"].extend(added["features"])
+
+    temp_path = vpc_path.with_name(f"{vpc_path.name}.part")
+    temp_path.write_text(json.dumps(vpc, indent=2), encoding="utf-8")
+    os.replace(temp_path, vpc_path)
+
+
+class TileManifest:
+    # tiles completely extracted into the output folder with their footprints from the feed (WGS 84 WKT),
+    # saved after every tile
+    FILE_NAME = "cuzk_tiles.json"
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+        self.path = folder / self.FILE_NAME
+        self.tiles = {}
+        self.vpc_files = set()
+
+        if self.path.exists():
+            try:
+                manifest = json.loads(self.path.read_text(encoding="utf-8"))
+                self.tiles = manifest["tiles"]
+                self.vpc_files = set(manifest["vpc_files"])
+            except (OSError, ValueError, KeyError, TypeError):
+                self.tiles = {}
+                self.vpc_files = set()
+
+        self._index = None
+        self._tile_ids = []
+
+    def is_complete(self, tile_id: str, updated: str) -> bool:
+        tile = self.tiles.get(tile_id)
+
+        if tile is None or tile["updated"] != updated:
+            return False
+
+        return all((self.folder / file).exists() for file in tile["files"])
+
+    def add(
+        self, tile_id: str, updated: str, data_type: str, files: List[str], footprint: Optional[QgsGeometry]
+    ) -> None:
+        # extent of points in the files is smaller than the tile, so the footprint is taken from the feed
+        self.tiles[tile_id] = {
+            "updated": updated,
+            "data_type": data_type,
+            "files": files,
+            "footprint": footprint.asWkt() if footprint is not None else None,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        }
+        self._index = None
+        self.save()
+
+    def set_footprint(self, tile_id: str, footprint: Optional[QgsGeometry]) -> None:
+        if footprint is None or self.tiles[tile_id].get("footprint"):
+            return
+
+        self.tiles[tile_id]["footprint"] = footprint.asWkt()
+        self._index = None
+        self.save()
+
+    def _footprint(self, tile_id: str) -> QgsGeometry:
+        return QgsGeometry.fromWkt(self.tiles[tile_id]["footprint"])
+
+    def files(self) -> Set[str]:
+        return {file for tile in self.tiles.values() for file in tile["files"]}
+
+    def set_vpc_files(self, files: Set[str]) -> None:
+        self.vpc_files = set(files)
+        self.save()
+
+    def tiles_in_extent(self, extent: QgsRectangle, data_type: str) -> List[str]:
+        if self._index is None:
+            self._index = QgsSpatialIndex()
+            self._tile_ids = []
+
+            for tile_id, tile in self.tiles.items():
+                if not tile.get("footprint"):
+                    continue
+                self._index.addFeature(len(self._tile_ids), self._footprint(tile_id).boundingBox())
+                self._tile_ids.append(tile_id)
+
+        tile_ids = [self._tile_ids[i] for i in self._index.intersects(extent)]
+
+        return [tile_id for tile_id in tile_ids if self.tiles[tile_id].get("data_type") == data_type]
+
+    def covers(self, extent: QgsRectangle, data_type: str) -> bool:
+        footprints = [
+            self._footprint(tile_id)
+            for tile_id in self.tiles_in_extent(extent, data_type)
+            if all((self.folder / file).exists() for file in self.tiles[tile_id]["files"])
+        ]
+
+        if not footprints:
+            return False
+
+        # small buffer closes gaps left by rounding of coordinates between neighbouring tiles
+        coverage = QgsGeometry.unaryUnion(footprints).buffer(FOOTPRINT_TOLERANCE, 1)
+
+        return coverage.contains(QgsGeometry.fromRect(extent))
+
+    def save(self) -> None:
+        temp_path = self.path.with_name(f"{self.FILE_NAME}.part")
+        manifest = {"tiles": self.tiles, "vpc_files": sorted(self.vpc_files)}
+        temp_path.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+        os.replace(temp_path, self.path)
+
+
+class TileCache:
+    # downloaded ZIP files named by hash of tile id and its update time, least recently used are evicted first
+    def __init__(self, folder: Path, max_size_mb: int):
+        self.folder = folder
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size_mb * 1024 * 1024
+
+        # files being downloaded or extracted by workers are never evicted
+        self._lock = threading.Lock()
+        self._in_use = set()
+
+    def _path(self, tile_id: str, updated: str) -> Path:
+        return self.folder / f"{tile_key(tile_id, updated)}.zip"
+
+    def get(self, tile_id: str, updated: str) -> Optional[Path]:
+        path = self._path(tile_id, updated)
+
+        with self._lock:
+            try:
+                # modification time is used as the last access time
+                os.utime(path)
+            except OSError:
+                return None
+
+            self._in_use.add(path)
+
+        return path
+
+    def part_path(self, tile_id: str, updated: str) -> Path:
+        path = self.folder / f"{tile_key(tile_id, updated)}.part"
+
+        with self._lock:
+            self._in_use.add(path)
+
+        return path
+
+    def put(self, tile_id: str, updated: str, downloaded: Path) -> Path:
+        path = self._path(tile_id, updated)
+
+        with self._lock:
+            os.replace(downloaded, path)
+            self._in_use.discard(downloaded)
+            self._in_use.add(path)
+
+        # cache is kept within its size during the run, not only at its end
+        self.evict()
+
+        return path
+
+    def release(self, path: Path) -> None:
+        with self._lock:
+            self._in_use.discard(path)
+
+    def evict(self) -> None:
+        with self._lock:
+            # unfinished downloads are evicted as well, otherwise they would stay in cache forever
+            entries = []
+            for path in [*self.folder.glob("*.zip"), *self.folder.glob("*.part")]:
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total_size = sum(size for _, size, _ in entries)
+
+            for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+                if total_size <= self.max_size:
+                    break
+
+                if path in self._in_use:
+                    continue
+
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+
+                total_size -= size
+
+
+class CancelableStream:
+    # stops reading of response once the algorithm is canceled, so running downloads do not block the cancel
+    def __init__(self, stream: BinaryIO, feedback: Optional[QgsProcessingFeedback]):
+        self.stream = stream
+        self.feedback = feedback
+
+    def read(self, size: Optional[int] = None) -> bytes:
+        if self.feedback is not None and self.feedback.isCanceled():
+            raise QgsProcessingException("Download was canceled.")
+
+        return self.stream.read() if size is None else self.stream.read(size)
+
+
+class TileDownloader:
+    CHUNK_SIZE = 1024 * 1024
+    TIMEOUT = 60
+    MAX_REDIRECTS = 5
+
+    def __init__(self):
+        # HTTP connections are kept alive and reused, each thread has its own connection per host
+        self._local = threading.local()
+
+    def _connection(self, url: urllib.parse.SplitResult) -> Tuple[http.client.HTTPConnection, str, Dict[str, str]]:
+        # connection, request target and headers, requests through HTTP proxy use absolute URL
+        connections = self._local.__dict__.setdefault("connections", {})
+
+        if (url.scheme, url.netloc) not in connections:
+            connections[(url.scheme, url.netloc)] = self._connect(url.scheme, url.netloc)
+
+        connection, via_proxy, headers = connections[(url.scheme, url.netloc)]
+
+        target = f"{url.path}?{url.query}" if url.query else url.path
+
+        return connection, url.geturl() if via_proxy else target, headers
+
+    def _connect(self, scheme: str, netloc: str) -> Tuple[http.client.HTTPConnection, bool, Dict[str, str]]:
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+
+        # proxy from environment or system settings, same as urllib uses
+        proxy = urllib.request.getproxies().get(scheme)
+        host = urllib.parse.urlsplit(f"//{netloc}").hostname
+
+        if not proxy or urllib.request.proxy_bypass(host):
+            return connection_class(netloc, timeout=self.TIMEOUT), False, {}
+
+        proxy_url = urllib.parse.urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+
+        headers = {}
+        if proxy_url.username:
+            credentials = f"{urllib.parse.unquote(proxy_url.username)}:{urllib.parse.unquote(proxy_url.password or '')}"
+            headers["Proxy-Authorization"] = f"Basic {base64.b64encode(credentials.encode('utf-8')).decode('ascii')}"
+
+        # HTTPS goes through a tunnel to the target host, plain HTTP requests are sent to the proxy
+        connection = connection_class(proxy_url.hostname, proxy_url.port, timeout=self.TIMEOUT)
+
+        if scheme == "https":
+            connection.set_tunnel(netloc, headers=headers)
+            return connection, False, {}
+
+        return connection, True, headers
+
+    def download(
+        self, link: str, path: Path, feedback: Optional[QgsProcessingFeedback] = None, redirects: int = 0
+    ) -> None:
+        url = urllib.parse.urlsplit(link)
+
+        # second attempt is made on a new connection, if the kept alive one was closed by server
+        for attempt in range(2):
+            connection, target, headers = self._connection(url)
+
+            # already downloaded part of the file (from previous attempt or run) is not downloaded again
+            offset = path.stat().st_size if path.exists() else 0
+            if offset:
+                headers = {**headers, "Range": f"bytes={offset}-"}
+
+            try:
+                connection.request("GET", target, headers=headers)
+                response = connection.getresponse()
+
+                if response.status in (301, 302, 303, 307, 308) and redirects < self.MAX_REDIRECTS:
+                    response.read()
+                    location = urllib.parse.urljoin(link, response.getheader("Location"))
+                    return self.download(location, path, feedback, redirects + 1)
+
+                if response.status == 416:
+                    response.read()
+
+                    if content_range(response.getheader("Content-Range"))[1] == offset:
+                        return
+
+                    # partial file does not match the file on server, download it again
+                    path.unlink()
+                    return self.download(link, path, feedback, redirects)
+
+                if response.status == 206 and content_range(response.getheader("Content-Range"))[0] == offset:
+                    mode = "ab"
+                    size = content_range(response.getheader("Content-Range"))[1]
+                elif response.status == 200:
+                    mode = "wb"
+                    size = response.getheader("Content-Length")
+                    size = int(size) if size is not None else None
+                else:
+                    response.read()
+                    raise QgsProcessingException(f"Download of {link} failed with HTTP status {response.status}.")
+
+                with open(path, mode) as file:
+                    shutil.copyfileobj(CancelableStream(response, feedback), file, self.CHUNK_SIZE)
+
+                if size is not None and path.stat().st_size != size:
+                    raise QgsProcessingException(
+                        f"Download of {link} is incomplete, {path.stat().st_size} of {size} bytes downloaded."
+                    )
+
+                return
+
+            except QgsProcessingException:
+                # response may not be fully read, so the connection can not be reused
+                connection.close()
+                raise
+
+            except (http.client.HTTPException, ConnectionError, socket.timeout):
+                connection.close()
+
+                if attempt == 1:
+                    raise
+
+    def stream(
+        self,
+        link: str,
+        consume: Callable[[BinaryIO], T],
+        feedback: Optional[QgsProcessingFeedback] = None,
+        redirects: int = 0,
+    ) -> T:
+        url = urllib.parse.urlsplit(link)
+
+        # the whole tile is consumed again on the second attempt, streamed data can not be resumed
+        for attempt in range(2):
+            connection, target, headers = self._connection(url)
+
+            try:
+                connection.request("GET", target, headers=headers)
+                response = connection.getresponse()
+
+                if response.status in (301, 302, 303, 307, 308) and redirects < self.MAX_REDIRECTS:
+                    response.read()
+                    location = urllib.parse.urljoin(link, response.getheader("Location"))
+                    return self.stream(location, consume, feedback, redirects + 1)
+
+                if response.status != 200:
+                    response.read()
+                    raise QgsProcessingException(f"Download of {link} failed with HTTP status {response.status}.")
+
+                stream = CancelableStream(response, feedback)
+
+                result = consume(stream)
+
+                # rest of the response is read, so the connection can be reused
+                stream.read()
+
+                return result
+
+            except QgsProcessingException:
+                connection.close()
+                raise
+
+            except (http.client.HTTPException, ConnectionError, socket.timeout):
+                connection.close()
+
+                if attempt == 1:
+                    raise
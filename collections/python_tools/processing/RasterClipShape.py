@@ -1,10 +1,22 @@
 import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from osgeo import gdal, ogr, osr
 
 from qgis.core import (QgsRasterFileWriter, QgsVectorFileWriter, QgsProcessingException,
                        QgsProcessingParameterDefinition, QgsProcessingParameterRasterLayer,
                        QgsProcessingParameterEnum, QgsProcessingParameterVectorLayer,
                        QgsProcessingParameterString, QgsProcessingParameterNumber,
-                       QgsProcessingParameterBoolean, QgsProcessingParameterRasterDestination)
+                       QgsProcessingParameterBoolean, QgsProcessingParameterRasterDestination,
+                       QgsProcessingFeedback, QgsVectorLayer, QgsWkbTypes,
+                       QgsProcessingParameterFolderDestination, QgsProcessingParameterField,
+                       QgsProcessingOutputMultipleLayers, QgsCoordinateTransform, QgsRasterLayer,
+                       QgsRectangle, QgsProcessingUtils, NULL)
 
 from processing.algs.gdal.GdalAlgorithm import GdalAlgorithm
 from processing.algs.gdal.GdalUtils import GdalUtils
@@ -19,7 +31,27 @@ class ClipRasterByExtent(GdalAlgorithm):
     OPTIONS = 'OPTIONS'
     DATA_TYPE = 'DATA_TYPE'
     EXTRA = 'EXTRA'
+    ENGINE = 'ENGINE'
     OUTPUT = 'OUTPUT'
+    OUTPUT_FOLDER = 'OUTPUT_FOLDER'
+    NAME_FIELD = 'NAME_FIELD'
+    THREADS = 'THREADS'
+    OUTPUT_FILES = 'OUTPUT_FILES'
+    WARP_THREADS = 'WARP_THREADS'
+    WARP_MEMORY = 'WARP_MEMORY'
+    CACHE_MAX = 'CACHE_MAX'
+    OUTPUT_PRESET = 'OUTPUT_PRESET'
+
+    ENGINES = ['gdalwarp', 'GDAL Python bindings']
+
+    OUTPUT_PRESETS = [
+        'Format default', 'Tiled', 'Tiled, DEFLATE compression', 'Tiled, LZW compression',
+        'Tiled, ZSTD compression'
+    ]
+
+    # creation options of presets, options not supported by output format are left out
+    OUTPUT_PRESET_OPTIONS = [[], ['TILED=YES'], ['TILED=YES', 'COMPRESS=DEFLATE'],
+                             ['TILED=YES', 'COMPRESS=LZW'], ['TILED=YES', 'COMPRESS=ZSTD']]
 
     def __init__(self):
         super().__init__()
@@ -96,8 +128,84 @@ class ClipRasterByExtent(GdalAlgorithm):
         extra_param.setFlags(extra_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
         self.addParameter(extra_param)
 
+        engine_param = QgsProcessingParameterEnum(self.ENGINE,
+                                                  self.tr('Clipping engine'),
+                                                  self.ENGINES,
+                                                  allowMultiple=False,
+                                                  defaultValue=0)
+        engine_param.setFlags(engine_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(engine_param)
+
+        threads_param = QgsProcessingParameterNumber(self.THREADS,
+                                                     self.tr('Number of threads'),
+                                                     type=QgsProcessingParameterNumber.Integer,
+                                                     minValue=1,
+                                                     defaultValue=1)
+        threads_param.setFlags(threads_param.flags() |
+                               QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(threads_param)
+
+        warp_threads_param = QgsProcessingParameterNumber(
+            self.WARP_THREADS,
+            self.tr('Number of warping threads'),
+            type=QgsProcessingParameterNumber.Integer,
+            minValue=1,
+            defaultValue=1)
+        warp_threads_param.setFlags(warp_threads_param.flags() |
+                                    QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(warp_threads_param)
+
+        warp_memory_param = QgsProcessingParameterNumber(
+            self.WARP_MEMORY,
+            self.tr('Warping memory (MB, 0 uses GDAL default)'),
+            type=QgsProcessingParameterNumber.Integer,
+            minValue=0,
+            defaultValue=0)
+        warp_memory_param.setFlags(warp_memory_param.flags() |
+                                   QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(warp_memory_param)
+
+        cache_max_param = QgsProcessingParameterNumber(
+            self.CACHE_MAX,
+            self.tr('GDAL block cache size (MB, 0 uses GDAL default)'),
+            type=QgsProcessingParameterNumber.Integer,
+            minValue=0,
+            defaultValue=0)
+        cache_max_param.setFlags(cache_max_param.flags() |
+                                 QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(cache_max_param)
+
+        output_preset_param = QgsProcessingParameterEnum(self.OUTPUT_PRESET,
+                                                         self.tr('Output tiling and compression'),
+                                                         self.OUTPUT_PRESETS,
+                                                         allowMultiple=False,
+                                                         defaultValue=0)
+        output_preset_param.setFlags(output_preset_param.flags() |
+                                     QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(output_preset_param)
+
+        self.addParameter(
+            QgsProcessingParameterField(self.NAME_FIELD,
+                                        self.tr('Field used to name rasters clipped by features'),
+                                        parentLayerParameterName=self.CLIP_LAYER,
+                                        optional=True))
+
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(self.OUTPUT,
+                                                    self.tr('Clipped raster'),
+                                                    optional=True,
+                                                    createByDefault=True))
+
+        # one raster per feature of clipping layer
         self.addParameter(
-            QgsProcessingParameterRasterDestination(self.OUTPUT, self.tr('Clipped raster')))
+            QgsProcessingParameterFolderDestination(self.OUTPUT_FOLDER,
+                                                    self.tr('Rasters clipped by each feature'),
+                                                    optional=True,
+                                                    createByDefault=False))
+
+        self.addOutput(
+            QgsProcessingOutputMultipleLayers(self.OUTPUT_FILES,
+                                              self.tr('Rasters clipped by each feature')))
 
     def checkParameterValues(self, parameters, context):
 
@@ -156,12 +264,32 @@ class ClipRasterByExtent(GdalAlgorithm):
         if data_type:
             arguments.append('-ot ' + self.TYPES[data_type])
 
+        driver_name = QgsRasterFileWriter.driverForExtension(os.path.splitext(out)[1])
+
         arguments.append('-of')
-        arguments.append(QgsRasterFileWriter.driverForExtension(os.path.splitext(out)[1]))
+        arguments.append(driver_name)
 
         if options:
             arguments.extend(GdalUtils.parseCreationOptions(options))
 
+        for option in self.presetCreationOptions(parameters, context, driver_name):
+            arguments.extend(['-co', option])
+
+        warp_threads = self.parameterAsInt(parameters, self.WARP_THREADS, context)
+
+        if warp_threads > 1:
+            arguments.extend(['-multi', '-wo', 'NUM_THREADS={}'.format(warp_threads)])
+
+        warp_memory = self.parameterAsInt(parameters, self.WARP_MEMORY, context)
+
+        if warp_memory:
+            arguments.extend(['-wm', warp_memory_limit(warp_memory)])
+
+        cache_max = self.parameterAsInt(parameters, self.CACHE_MAX, context)
+
+        if cache_max:
+            arguments.extend(['--config', 'GDAL_CACHEMAX', str(cache_max)])
+
         if self.EXTRA in parameters and parameters[self.EXTRA] not in (None, ''):
             extra = self.parameterAsString(parameters, self.EXTRA, context)
             arguments.append(extra)
@@ -170,3 +298,449 @@ class ClipRasterByExtent(GdalAlgorithm):
         arguments.append(out)
 
         return [self.commandName(), GdalUtils.escapeAndJoin(arguments)]
+
+    def processAlgorithm(self, parameters, context, feedback):
+
+        out = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+
+        out_folder = self.parameterAsString(parameters, self.OUTPUT_FOLDER, context)
+
+        if not out and not out_folder:
+            raise QgsProcessingException(
+                self.tr('Clipped raster or folder for per feature rasters must be set.'))
+
+        results = {}
+
+        # gdalwarp gets the cache size in its command line, only in process clipping changes it
+        cache_max = self.parameterAsInt(parameters, self.CACHE_MAX, context)
+
+        if out and self.parameterAsEnum(parameters, self.ENGINE, context) == 0:
+            results = super().processAlgorithm(parameters, context, feedback)
+
+        elif out:
+            with gdal_cache_max(cache_max):
+                results = self.clipInProcess(parameters, context, feedback, out)
+
+        # per feature clipping always runs in process, source raster is opened once per thread
+        if out_folder:
+            results[self.OUTPUT_FOLDER] = out_folder
+
+            with gdal_cache_max(cache_max):
+                results[self.OUTPUT_FILES] = self.clipByFeatures(parameters, context, feedback,
+                                                                 out_folder)
+
+        return results
+
+    def inputLayers(self, parameters, context) -> Tuple[QgsRasterLayer, QgsVectorLayer]:
+
+        inLayer = self.parameterAsRasterLayer(parameters, self.INPUT, context)
+
+        if inLayer is None:
+            raise QgsProcessingException('Invalid input layer {}'.format(
+                parameters[self.INPUT] if self.INPUT in parameters else 'INPUT'))
+
+        if inLayer.providerType() != 'gdal':
+            raise QgsProcessingException(
+                self.tr('GDAL Python bindings engine requires raster layer readable by GDAL.'))
+
+        clip_layer = self.parameterAsVectorLayer(parameters, self.CLIP_LAYER, context)
+
+        if clip_layer.geometryType() != QgsWkbTypes.PolygonGeometry:
+            raise QgsProcessingException(self.tr('Clipping layer must be polygon layer.'))
+
+        return inLayer, clip_layer
+
+    def presetCreationOptions(self, parameters, context, driver_name: str) -> List[str]:
+
+        preset = self.parameterAsEnum(parameters, self.OUTPUT_PRESET, context)
+
+        driver = gdal.GetDriverByName(driver_name)
+
+        if not preset or driver is None:
+            return []
+
+        return supported_creation_options(driver, self.OUTPUT_PRESET_OPTIONS[preset])
+
+    def creationOptions(self, parameters, context, driver_name: str) -> List[str]:
+
+        options = self.parameterAsString(parameters, self.OPTIONS, context)
+
+        # options set by user take precedence over the preset, GDAL uses the first value of option
+        creation_options = [option for option in options.split('|') if option]
+
+        return creation_options + self.presetCreationOptions(parameters, context, driver_name)
+
+    def warpArguments(self, parameters, context, inLayer: QgsRasterLayer, driver_name: str) -> Dict:
+
+        override_crs = self.parameterAsBoolean(parameters, self.OVERCRS, context)
+
+        if self.NODATA in parameters and parameters[self.NODATA] is not None:
+            nodata = self.parameterAsDouble(parameters, self.NODATA, context)
+        else:
+            nodata = None
+
+        crs = inLayer.crs()
+
+        source_srs = None
+
+        if override_crs and crs.isValid():
+            source_srs = GdalUtils.gdal_crs_string(crs)
+
+        data_type = self.parameterAsEnum(parameters, self.DATA_TYPE, context)
+
+        output_type = gdal.GDT_Unknown
+
+        if data_type:
+            output_type = gdal.GetDataTypeByName(self.TYPES[data_type])
+
+        extra = None
+
+        if self.EXTRA in parameters and parameters[self.EXTRA] not in (None, ''):
+            extra = self.parameterAsString(parameters, self.EXTRA, context)
+
+        warp_threads = self.parameterAsInt(parameters, self.WARP_THREADS, context)
+
+        warp_memory = self.parameterAsInt(parameters, self.WARP_MEMORY, context)
+
+        return {
+            'options': extra,
+            'cropToCutline': True,
+            'srcSRS': source_srs,
+            'srcNodata': nodata,
+            'outputType': output_type,
+            'creationOptions': self.creationOptions(parameters, context, driver_name),
+            'multithread': warp_threads > 1,
+            'warpOptions': ['NUM_THREADS={}'.format(warp_threads)] if warp_threads > 1 else None,
+            'warpMemoryLimit': warp_memory_limit(warp_memory) if warp_memory else None
+        }
+
+    def clipInProcess(self, parameters, context, feedback, out: str) -> Dict:
+
+        # raster is warped in process with cutline kept in memory, without gdalwarp and layer export
+        inLayer, clip_layer = self.inputLayers(parameters, context)
+
+        driver_name = QgsRasterFileWriter.driverForExtension(os.path.splitext(out)[1])
+
+        driver = gdal.GetDriverByName(driver_name)
+
+        if driver is None:
+            raise QgsProcessingException('Unknown raster format {}.'.format(driver_name))
+
+        # formats without direct creation are warped into intermediate raster and copied at the end
+        direct_create = driver.GetMetadataItem(gdal.DCAP_CREATE) == 'YES'
+
+        warp_arguments = self.warpArguments(parameters, context, inLayer,
+                                            driver_name if direct_create else 'GTiff')
+
+        creation_options = self.creationOptions(parameters, context, driver_name)
+
+        intermediates = IntermediateRasters()
+
+        if direct_create:
+            target = out
+        else:
+            # clipped raster is not larger than the input, unknown output type is counted as the
+            # largest real type
+            output_type = warp_arguments['outputType']
+            pixel_size = gdal.GetDataTypeSize(output_type) // 8 if output_type else 8
+
+            target = intermediates.path(inLayer.width() * inLayer.height() * inLayer.bandCount() *
+                                        pixel_size)
+
+            warp_arguments['creationOptions'] = warp_arguments['creationOptions'] + [
+                'BIGTIFF=IF_SAFER'
+            ]
+
+        cutline_path = '/vsimem/cutline_{}.shp'.format(uuid.uuid4().hex)
+
+        output_ds = None
+
+        try:
+
+            cutline_layer_name, _ = cutline_to_ogr(clip_layer, cutline_path, feedback)
+
+            warp_options = gdal.WarpOptions(format=driver_name if direct_create else 'GTiff',
+                                            cutlineDSName=cutline_path,
+                                            cutlineLayer=cutline_layer_name,
+                                            callback=gdal_progress,
+                                            callback_data=feedback,
+                                            **warp_arguments)
+
+            output_ds = gdal.Warp(target, inLayer.source(), options=warp_options)
+
+            if output_ds is None:
+                raise QgsProcessingException('Clipping of raster {} failed: {}'.format(
+                    inLayer.source(), gdal.GetLastErrorMsg()))
+
+            if not direct_create:
+                driver.CreateCopy(out, output_ds, options=creation_options)
+
+            output_ds.FlushCache()
+
+        finally:
+
+            output_ds = None
+
+            ogr.GetDriverByName('ESRI Shapefile').DeleteDataSource(cutline_path)
+
+            intermediates.cleanup()
+
+        return {self.OUTPUT: out}
+
+    def clipByFeatures(self, parameters, context, feedback, out_folder: str) -> List[str]:
+
+        inLayer, clip_layer = self.inputLayers(parameters, context)
+
+        warp_arguments = self.warpArguments(parameters, context, inLayer, 'GTiff')
+
+        name_field = self.parameterAsString(parameters, self.NAME_FIELD, context)
+
+        threads = self.parameterAsInt(parameters, self.THREADS, context)
+
+        os.makedirs(out_folder, exist_ok=True)
+
+        cutline_path = '/vsimem/cutline_{}.shp'.format(uuid.uuid4().hex)
+
+        # each thread opens the source raster once and uses it for all its features
+        local = threading.local()
+
+        def clip_feature(cutline_fid: int, out: str) -> str:
+
+            if not hasattr(local, 'source_ds'):
+                local.source_ds = gdal.Open(inLayer.source(), gdal.GA_ReadOnly)
+
+            if local.source_ds is None:
+                raise QgsProcessingException('Could not open raster {}.'.format(
+                    inLayer.source()))
+
+            # warper reads only the window of source raster covered by the feature
+            warp_options = gdal.WarpOptions(format='GTiff',
+                                            cutlineDSName=cutline_path,
+                                            cutlineLayer=cutline_layer_name,
+                                            cutlineWhere='FID = {}'.format(cutline_fid),
+                                            **warp_arguments)
+
+            output_ds = gdal.Warp(out, local.source_ds, options=warp_options)
+
+            if output_ds is None:
+                raise QgsProcessingException('Clipping of raster by feature {} failed: {}'.format(
+                    cutline_fid, gdal.GetLastErrorMsg()))
+
+            output_ds = None
+
+            return out
+
+        outputs = []
+
+        try:
+
+            cutline_layer_name, features = cutline_to_ogr(clip_layer, cutline_path, feedback,
+                                                          name_field)
+
+            transform = QgsCoordinateTransform(clip_layer.crs(), inLayer.crs(),
+                                               context.transformContext())
+
+            raster_extent = inLayer.extent()
+
+            names = set()
+
+            tasks = []
+
+            for cutline_fid, (feature_id, name, extent) in enumerate(features):
+
+                # features outside of the raster would produce empty rasters
+                if not transform.transformBoundingBox(extent).intersects(raster_extent):
+                    feedback.pushInfo(
+                        self.tr('Feature {} does not intersect input raster.').format(feature_id))
+                    continue
+
+                file_name = feature_file_name(name, feature_id, names)
+
+                tasks.append((cutline_fid, os.path.join(out_folder, '{}.tif'.format(file_name))))
+
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+
+                futures = [executor.submit(clip_feature, *task) for task in tasks]
+
+                for i, future in enumerate(as_completed(futures)):
+
+                    if feedback.isCanceled():
+                        for not_done in futures:
+                            not_done.cancel()
+                        break
+
+                    outputs.append(future.result())
+
+                    feedback.setProgress(((i + 1) / len(tasks)) * 100)
+
+        finally:
+
+            ogr.GetDriverByName('ESRI Shapefile').DeleteDataSource(cutline_path)
+
+        return sorted(outputs)
+
+
+@contextmanager
+def gdal_cache_max(megabytes: int) -> Iterator[None]:
+
+    # block cache is global for the whole QGIS process, so it is changed only for the time of
+    # clipping and the original size is restored afterwards
+    if not megabytes:
+        yield
+        return
+
+    original_cache_max = gdal.GetCacheMax()
+
+    gdal.SetCacheMax(megabytes * 1024 * 1024)
+
+    try:
+        yield
+    finally:
+        gdal.SetCacheMax(original_cache_max)
+
+
+def warp_memory_limit(megabytes: int) -> str:
+
+    # gdalwarp reads values below 10000 as megabytes and larger values as bytes
+    if megabytes < 10000:
+        return str(megabytes)
+
+    return str(megabytes * 1024 * 1024)
+
+
+def supported_creation_options(driver: gdal.Driver, options: List[str]) -> List[str]:
+
+    option_list = driver.GetMetadataItem(gdal.DMD_CREATIONOPTIONLIST) or ''
+
+    return [
+        option for option in options
+        if "name='{}'".format(option.split('=')[0]) in option_list
+    ]
+
+
+# feature id, name and extent of feature stored in cutline
+CutlineFeature = Tuple[int, Optional[str], QgsRectangle]
+
+
+def feature_file_name(name: Optional[str], feature_id: int, names: set) -> str:
+
+    file_name = re.sub(r'[^\w\-.]+', '_', name).strip('._') if name else ''
+
+    # features without name or with duplicate names are distinguished by feature id
+    if not file_name or file_name in names:
+        file_name = '{}_{}'.format(file_name, feature_id) if file_name else str(feature_id)
+
+    names.add(file_name)
+
+    return file_name
+
+
+def cutline_to_ogr(vector_layer: QgsVectorLayer,
+                   path: str,
+                   feedback: QgsProcessingFeedback,
+                   name_field: Optional[str] = None) -> Tuple[str, List[CutlineFeature]]:
+
+    cutline_ds = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(path)
+
+    if cutline_ds is None:
+        raise QgsProcessingException('Could not create cutline {}.'.format(path))
+
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(vector_layer.crs().toWkt())
+
+    layer = cutline_ds.CreateLayer(os.path.splitext(os.path.basename(path))[0], srs,
+                                   ogr.wkbMultiPolygon)
+
+    # features in order of cutline FIDs, with their ids, names and extents
+    features = []
+
+    for feature in vector_layer.getFeatures():
+
+        if feedback.isCanceled():
+            break
+
+        if not feature.hasGeometry():
+            continue
+
+        name = None
+
+        if name_field:
+            value = feature.attribute(name_field)
+            name = str(value) if value is not None and value != NULL else None
+
+        features.append((feature.id(), name, feature.geometry().boundingBox()))
+
+        # curved geometries can not be stored in shapefile
+        geometry = feature.geometry().constGet().segmentize()
+
+        ogr_feature = ogr.Feature(layer.GetLayerDefn())
+        ogr_feature.SetGeometry(
+            ogr.ForceToMultiPolygon(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb()))))
+
+        layer.CreateFeature(ogr_feature)
+
+    layer_name = layer.GetName()
+
+    # data are written to memory file on close
+    layer = None
+    cutline_ds = None
+
+    return layer_name, features
+
+
+def gdal_progress(complete: float, message: str, feedback: QgsProcessingFeedback) -> int:
+
+    feedback.setProgress(int(complete * 100))
+
+    return 0 if feedback.isCanceled() else 1
+
+
+class IntermediateRasters:
+
+    # scripts of the collection are loaded by QGIS one by one and can not import each other, so
+    # this class is copied unchanged into every script that needs it
+
+    # rasters up to this size in bytes are kept in memory, larger ones in temporary folder
+    MEMORY_LIMIT = 256 * 1024 * 1024
+
+    def __init__(self, memory_limit: int = MEMORY_LIMIT):
+
+        self.memory_limit = memory_limit
+        self.paths: List[str] = []
+
+    def path(self, size: int) -> str:
+
+        file_name = "intermediate_{}.tif".format(uuid.uuid4().hex)
+
+        if size <= self.memory_limit:
+            path = "/vsimem/{}".format(file_name)
+        else:
+            path = os.path.join(QgsProcessingUtils.tempFolder(), file_name)
+
+        self.paths.append(path)
+
+        return path
+
+    def create(self, width: int, height: int, band_count: int, data_type: int) -> gdal.Dataset:
+
+        size = width * height * band_count * gdal.GetDataTypeSize(data_type) // 8
+
+        path = self.path(size)
+
+        dataset = gdal.GetDriverByName("GTiff").Create(path, width, height, band_count,
+                                                       data_type,
+                                                       ["TILED=YES", "BIGTIFF=IF_SAFER"])
+
+        if dataset is None:
+            raise QgsProcessingException("Could not create intermediate raster {}.".format(path))
+
+        return dataset
+
+    def cleanup(self) -> None:
+
+        # datasets have to be closed before, otherwise the files can not be removed
+        for path in self.paths:
+            if gdal.VSIStatL(path) is not None:
+                gdal.GetDriverByName("GTiff").Delete(path)
+
+        self.paths = []
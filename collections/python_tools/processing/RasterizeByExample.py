@@ -1,9 +1,24 @@
+import os
+import uuid
+from typing import List, Optional, Tuple
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
 from qgis.core import (QgsProcessingAlgorithm, QgsProcessingParameterVectorLayer,
                        QgsProcessingParameterRasterLayer, QgsProcessingParameterField,
                        QgsProcessingParameterRasterDestination, QgsRectangle,
-                       QgsCoordinateReferenceSystem, QgsRasterDataProvider, QgsRasterInterface)
+                       QgsCoordinateReferenceSystem, QgsRasterDataProvider, QgsProcessingException,
+                       QgsFeatureRequest, QgsFeature, QgsVectorLayer, QgsProcessingContext,
+                       QgsProcessingFeedback, QgsProcessingUtils, NULL)
+
+from processing.algs.gdal.GdalUtils import GdalUtils
+
+OGR_VALUE_FIELD = "value"
+OGR_COVERAGE_FIELD = "coverage"
 
-from qgis import processing
+# compressions of example raster that can be used for output
+LOSSLESS_COMPRESSIONS = ['NONE', 'LZW', 'DEFLATE', 'ZSTD', 'PACKBITS', 'LZMA']
 
 
 class RasterizeByExampleAlgorithm(QgsProcessingAlgorithm):
@@ -34,8 +49,11 @@ class RasterizeByExampleAlgorithm(QgsProcessingAlgorithm):
             QgsProcessingParameterVectorLayer(self.INPUT, 'Vector layer', defaultValue=None))
 
         self.addParameter(
-            QgsProcessingParameterField(self.FIELD, 'Field to rasterize',
-                                        QgsProcessingParameterField.Numeric, self.INPUT))
+            QgsProcessingParameterField(self.FIELD,
+                                        'Fields to rasterize (one band per field)',
+                                        type=QgsProcessingParameterField.Numeric,
+                                        parentLayerParameterName=self.INPUT,
+                                        allowMultiple=True))
 
         self.addParameter(
             QgsProcessingParameterRasterLayer(self.EXAMPLE,
@@ -48,30 +66,308 @@ class RasterizeByExampleAlgorithm(QgsProcessingAlgorithm):
 
         input = self.parameterAsVectorLayer(parameters, self.INPUT, context)
         raster_template = self.parameterAsRasterLayer(parameters, self.EXAMPLE, context)
-        field_name_vectorize = self.parameterAsString(parameters, self.FIELD, context)
+        field_names = self.parameterAsFields(parameters, self.FIELD, context)
         output = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
 
         extent: QgsRectangle = raster_template.extent()
 
         raster_data_provider: QgsRasterDataProvider = raster_template.dataProvider()
-        no_data = raster_data_provider.sourceNoDataValue(1)
-
-        result = processing.run(
-            "gdal:rasterize", {
-                'INPUT': input,
-                'FIELD': field_name_vectorize,
-                'BURN': 0,
-                'UNITS': 0,
-                'WIDTH': raster_data_provider.xSize(),
-                'HEIGHT': raster_data_provider.ySize(),
-                'EXTENT': extent,
-                'NODATA': no_data,
-                'OPTIONS': '',
-                'DATA_TYPE': 5,
-                'INIT': None,
-                'INVERT': False,
-                'EXTRA': '',
-                'OUTPUT': output
-            })
-
-        return {self.OUTPUT: result["OUTPUT"]}
+        no_data = None
+
+        if raster_data_provider.sourceHasNoDataValue(1):
+            no_data = raster_data_provider.sourceNoDataValue(1)
+
+        width = raster_data_provider.xSize()
+        height = raster_data_provider.ySize()
+
+        geotransform = (extent.xMinimum(), extent.width() / width, 0, extent.yMaximum(), 0,
+                        -extent.height() / height)
+        projection = raster_template.crs().toWkt()
+        data_type = gdal.GDT_Float32
+        creation_options = []
+
+        # grid, data type and block layout are taken from the file if GDAL can read it
+        if raster_template.providerType() == 'gdal':
+
+            template_ds = gdal.Open(raster_template.source(), gdal.GA_ReadOnly)
+
+            if template_ds is not None:
+                geotransform, projection, data_type, creation_options = template_layout(
+                    template_ds)
+
+            template_ds = None
+
+        # vector layer is rasterized in process from memory, without export and gdal_rasterize
+        polygons_ds, values = vector_to_ogr(input, field_names, raster_template.crs(), context,
+                                            feedback)
+
+        driver_name = GdalUtils.getFormatShortNameFromFilename(output)
+
+        driver = gdal.GetDriverByName(driver_name)
+
+        if driver is None:
+            raise QgsProcessingException('Unknown raster format {}.'.format(driver_name))
+
+        # formats without direct creation are rasterized into intermediate raster and copied at
+        # the end
+        direct_create = driver.GetMetadataItem(gdal.DCAP_CREATE) == 'YES'
+
+        intermediates = IntermediateRasters()
+
+        if direct_create:
+            target = output
+            target_driver = driver
+            target_options = creation_options
+        else:
+            target = intermediates.path(width * height * len(field_names) *
+                                        gdal.GetDataTypeSize(data_type) // 8)
+            target_driver = gdal.GetDriverByName('GTiff')
+            target_options = creation_options + ['BIGTIFF=IF_SAFER']
+
+        try:
+
+            output_ds = target_driver.Create(
+                target, width, height, len(field_names), data_type,
+                supported_creation_options(target_driver, target_options))
+
+            if output_ds is None:
+                raise QgsProcessingException('Could not create output raster {}.'.format(output))
+
+            output_ds.SetGeoTransform(geotransform)
+            output_ds.SetProjection(projection)
+
+            for i, field_name in enumerate(field_names):
+
+                output_band = output_ds.GetRasterBand(i + 1)
+                output_band.SetDescription(field_name)
+
+                if no_data is not None:
+                    output_band.SetNoDataValue(no_data)
+
+            if len(field_names) == 1:
+
+                if no_data is not None:
+                    output_ds.GetRasterBand(1).Fill(no_data)
+
+                gdal.RasterizeLayer(output_ds, [1],
+                                    polygons_ds.GetLayer(0),
+                                    options=['ATTRIBUTE={}'.format(OGR_VALUE_FIELD)],
+                                    callback=gdal_progress,
+                                    callback_data=feedback)
+
+            else:
+
+                # coverage of pixels by features is rasterized once and shared by all fields
+                burn_by_coverage(output_ds, polygons_ds.GetLayer(0), values, no_data, feedback)
+
+            if not direct_create:
+                driver.CreateCopy(output, output_ds,
+                                  options=supported_creation_options(driver, creation_options))
+
+            output_ds.FlushCache()
+
+        finally:
+
+            output_ds = None
+            intermediates.cleanup()
+
+        return {self.OUTPUT: output}
+
+
+def vector_to_ogr(vector_layer: QgsVectorLayer, field_names: List[str],
+                  crs: QgsCoordinateReferenceSystem, context: QgsProcessingContext,
+                  feedback: QgsProcessingFeedback) -> Tuple[ogr.DataSource, np.ndarray]:
+
+    vector_ds = ogr.GetDriverByName('Memory').CreateDataSource('vector')
+
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(crs.toWkt())
+
+    layer = vector_ds.CreateLayer('vector', srs, ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn(OGR_VALUE_FIELD, ogr.OFTReal))
+    layer.CreateField(ogr.FieldDefn(OGR_COVERAGE_FIELD, ogr.OFTInteger))
+
+    request = QgsFeatureRequest().setDestinationCrs(crs, context.transformContext())
+    request.setSubsetOfAttributes(field_names, vector_layer.fields())
+
+    # row 0 is reserved for pixels without any feature, features are numbered from 1
+    values = [[0.0] * len(field_names)]
+
+    feature: QgsFeature
+
+    for feature in vector_layer.getFeatures(request):
+
+        if feedback.isCanceled():
+            break
+
+        if not feature.hasGeometry():
+            continue
+
+        ogr_feature = ogr.Feature(layer.GetLayerDefn())
+        ogr_feature.SetGeometry(ogr.CreateGeometryFromWkb(bytes(feature.geometry().asWkb())))
+
+        feature_values = []
+
+        # missing values are burned as 0
+        for field_name in field_names:
+
+            value = feature.attribute(field_name)
+
+            feature_values.append(float(value) if value is not None and value != NULL else 0.0)
+
+        ogr_feature.SetField(OGR_VALUE_FIELD, feature_values[0])
+        ogr_feature.SetField(OGR_COVERAGE_FIELD, len(values))
+
+        values.append(feature_values)
+
+        layer.CreateFeature(ogr_feature)
+
+    return vector_ds, np.array(values, dtype=np.float64)
+
+
+def burn_by_coverage(output_ds: gdal.Dataset, layer: ogr.Layer, values: np.ndarray,
+                     no_data: Optional[float], feedback: QgsProcessingFeedback) -> None:
+
+    width = output_ds.RasterXSize
+    height = output_ds.RasterYSize
+
+    intermediates = IntermediateRasters()
+
+    try:
+
+        coverage_ds = intermediates.create(width, height, 1, gdal.GDT_UInt32)
+
+        coverage_ds.SetGeoTransform(output_ds.GetGeoTransform())
+        coverage_ds.SetProjection(output_ds.GetProjection())
+
+        gdal.RasterizeLayer(coverage_ds, [1],
+                            layer,
+                            options=['ATTRIBUTE={}'.format(OGR_COVERAGE_FIELD)],
+                            callback=gdal_progress,
+                            callback_data=feedback)
+
+        table = values.copy()
+        table[0, :] = no_data if no_data is not None else 0
+
+        coverage_band = coverage_ds.GetRasterBand(1)
+
+        block_width, block_height = output_ds.GetRasterBand(1).GetBlockSize()
+
+        tile_width = max(block_width, (1024 // block_width) * block_width)
+        tile_height = max(block_height, (1024 // block_height) * block_height)
+
+        for y_off in range(0, height, tile_height):
+
+            if feedback.isCanceled():
+                break
+
+            for x_off in range(0, width, tile_width):
+
+                coverage = coverage_band.ReadAsArray(x_off, y_off, min(tile_width, width - x_off),
+                                                     min(tile_height, height - y_off))
+
+                for i in range(table.shape[1]):
+                    output_ds.GetRasterBand(i + 1).WriteArray(table[coverage, i], x_off, y_off)
+
+            feedback.setProgress(int(100.0 * min(y_off + tile_height, height) / height))
+
+    finally:
+
+        coverage_ds = None
+        intermediates.cleanup()
+
+
+def gdal_progress(complete: float, message: str, feedback: QgsProcessingFeedback) -> int:
+
+    feedback.setProgress(int(complete * 100))
+
+    return 0 if feedback.isCanceled() else 1
+
+
+def template_layout(template_ds: gdal.Dataset) -> Tuple[Tuple[float, ...], str, int, List[str]]:
+
+    band = template_ds.GetRasterBand(1)
+
+    block_width, block_height = band.GetBlockSize()
+
+    if block_width < template_ds.RasterXSize:
+        options = [
+            'TILED=YES', 'BLOCKXSIZE={}'.format(block_width), 'BLOCKYSIZE={}'.format(block_height)
+        ]
+    else:
+        options = ['BLOCKYSIZE={}'.format(block_height)]
+
+    compression = (template_ds.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE') or '').upper()
+
+    # lossy compressions (JPEG, WEBP, LERC...) would change burned values, they are not inherited
+    if compression in LOSSLESS_COMPRESSIONS:
+
+        options.append('COMPRESS={}'.format(compression))
+
+        predictor = template_ds.GetMetadataItem('PREDICTOR', 'IMAGE_STRUCTURE')
+
+        if predictor and compression != 'PACKBITS':
+            options.append('PREDICTOR={}'.format(predictor))
+
+    return (template_ds.GetGeoTransform(), template_ds.GetProjection(), band.DataType, options)
+
+
+def supported_creation_options(driver: gdal.Driver, options: List[str]) -> List[str]:
+
+    option_list = driver.GetMetadataItem(gdal.DMD_CREATIONOPTIONLIST) or ''
+
+    return [
+        option for option in options
+        if "name='{}'".format(option.split('=')[0]) in option_list
+    ]
+
+
+class IntermediateRasters:
+
+    # scripts of the collection are loaded by QGIS one by one and can not import each other, so
+    # this class is copied unchanged into every script that needs it
+
+    # rasters up to this size in bytes are kept in memory, larger ones in temporary folder
+    MEMORY_LIMIT = 256 * 1024 * 1024
+
+    def __init__(self, memory_limit: int = MEMORY_LIMIT):
+
+        self.memory_limit = memory_limit
+        self.paths: List[str] = []
+
+    def path(self, size: int) -> str:
+
+        file_name = "intermediate_{}.tif".format(uuid.uuid4().hex)
+
+        if size <= self.memory_limit:
+            path = "/vsimem/{}".format(file_name)
+        else:
+            path = os.path.join(QgsProcessingUtils.tempFolder(), file_name)
+
+        self.paths.append(path)
+
+        return path
+
+    def create(self, width: int, height: int, band_count: int, data_type: int) -> gdal.Dataset:
+
+        size = width * height * band_count * gdal.GetDataTypeSize(data_type) // 8
+
+        path = self.path(size)
+
+        dataset = gdal.GetDriverByName("GTiff").Create(path, width, height, band_count,
+                                                       data_type,
+                                                       ["TILED=YES", "BIGTIFF=IF_SAFER"])
+
+        if dataset is None:
+            raise QgsProcessingException("Could not create intermediate raster {}.".format(path))
+
+        return dataset
+
+    def cleanup(self) -> None:
+
+        # datasets have to be closed before, otherwise the files can not be removed
+        for path in self.paths:
+            if gdal.VSIStatL(path) is not None:
+                gdal.GetDriverByName("GTiff").Delete(path)
+
+        self.paths = []
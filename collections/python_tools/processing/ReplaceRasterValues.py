@@ -1,14 +1,26 @@
+import math
+import os
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Iterator, List, Optional, Tuple
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
 from qgis.core import (QgsProcessing, QgsProcessingAlgorithm, QgsProcessingParameterNumber,
                        QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterRasterDestination, QgsProcessingParameterField,
-                       QgsProcessingParameterRasterLayer, QgsRasterLayer, QgsProcessingException)
+                       QgsProcessingParameterRasterLayer, QgsProcessingException,
+                       QgsFeatureRequest, QgsFeature, QgsVectorLayer,
+                       QgsCoordinateReferenceSystem, QgsProcessingContext, QgsProcessingFeedback,
+                       QgsProcessingParameterBand, QgsProcessingParameterDefinition,
+                       QgsProcessingUtils)
 
-from qgis.analysis import (QgsRasterCalculatorEntry, QgsRasterCalculator)
-import processing
 from processing.algs.gdal.GdalUtils import GdalUtils
 
-import tempfile
-import uuid
+OGR_VALUE_FIELD = "value"
 
 
 class ReplaceRasterValuesAlgorithm(QgsProcessingAlgorithm):
@@ -18,6 +30,11 @@ class ReplaceRasterValuesAlgorithm(QgsProcessingAlgorithm):
     OUTPUT_RASTER = "OutputRaster"
     RASTER_VALUE = "RasterValue"
     VALUE_FIELD = "ValueField"
+    BANDS = "Bands"
+    THREADS = "Threads"
+
+    # approximate size of raster tile processed at once, in pixels along each side
+    TILE_SIZE = 1024
 
     def name(self):
         return "replacerastervalues"
@@ -53,6 +70,22 @@ class ReplaceRasterValuesAlgorithm(QgsProcessingAlgorithm):
                                         type=QgsProcessingParameterField.Numeric,
                                         optional=True))
 
+        self.addParameter(
+            QgsProcessingParameterBand(self.BANDS,
+                                       "Bands (all bands if not set)",
+                                       parentLayerParameterName=self.RASTER_LAYER,
+                                       optional=True,
+                                       allowMultiple=True))
+
+        threads_param = QgsProcessingParameterNumber(self.THREADS,
+                                                     "Number of threads",
+                                                     type=QgsProcessingParameterNumber.Integer,
+                                                     minValue=1,
+                                                     defaultValue=1)
+        threads_param.setFlags(threads_param.flags() |
+                               QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(threads_param)
+
         self.addParameter(
             QgsProcessingParameterRasterDestination(self.OUTPUT_RASTER, "Output Raster"))
 
@@ -72,89 +105,417 @@ class ReplaceRasterValuesAlgorithm(QgsProcessingAlgorithm):
 
         output_raster = self.parameterAsOutputLayer(parameters, self.OUTPUT_RASTER, context)
 
-        raster_crs = raster_layer.crs()
+        if raster_layer.providerType() != "gdal":
+            raise QgsProcessingException("Raster layer has to be a raster file readable by GDAL.")
 
-        raster_one_value = "{}/raster_one_{}.tif".format(tempfile.gettempdir(), uuid.uuid4().hex)
+        source_ds = gdal.Open(raster_layer.source(), gdal.GA_ReadOnly)
 
-        if 0 < len(value_field_name):
-            raster_values = "{}/raster_values_{}.tif".format(tempfile.gettempdir(),
-                                                             uuid.uuid4().hex)
-
-        raster_extent = raster_layer.dataProvider().extent()
-
-        params = {
-            'BURN': raster_new_value,
-            'DATA_TYPE': 5,
-            'EXTENT': raster_extent,
-            'EXTRA': '',
-            'FIELD': '',
-            'INIT': 0,
-            'INPUT': vector_layer,
-            'INVERT': False,
-            'NODATA': None,
-            'OPTIONS': '',
-            'OUTPUT': raster_one_value,
-            'UNITS': 1,
-            'WIDTH': raster_layer.dataProvider().xSize(),
-            'HEIGHT': raster_layer.dataProvider().ySize()
-        }
-
-        processing.run("gdal:rasterize", params)
+        if source_ds is None:
+            raise QgsProcessingException("Could not open raster layer {}.".format(
+                raster_layer.source()))
 
-        if 0 < len(value_field_name):
-            params.update({
-                'FIELD': value_field_name,
-                'OUTPUT': raster_values,
-                'BURN': 0,
-                'NODATA': None,
-                'INIT': 0
-            })
+        polygons_ds = polygons_to_ogr(vector_layer, value_field_name, raster_layer.crs(), context,
+                                      feedback)
 
-            processing.run("gdal:rasterize", params)
+        polygons = polygons_ds.GetLayer(0)
 
-        temp_raster = QgsRasterLayer(raster_one_value)
+        bands = self.parameterAsInts(parameters, self.BANDS, context)
 
-        one_value_raster = QgsRasterCalculatorEntry()
-        one_value_raster.ref = 'one_value_raster@1'
-        one_value_raster.raster = temp_raster
-        one_value_raster.bandNumber = 1
+        if not bands:
+            bands = list(range(1, source_ds.RasterCount + 1))
 
-        org_raster = QgsRasterCalculatorEntry()
-        org_raster.ref = 'org_rast@1'
-        org_raster.raster = raster_layer
-        org_raster.bandNumber = 1
+        threads = self.parameterAsInt(parameters, self.THREADS, context)
 
-        raster_entries = []
-        raster_entries.append(one_value_raster)
-        raster_entries.append(org_raster)
+        no_data = [source_ds.GetRasterBand(band).GetNoDataValue() for band in bands]
 
-        expression = "({0} != {1}) * {2} + {0}".format(one_value_raster.ref, raster_new_value,
-                                                       org_raster.ref)
+        driver_name = GdalUtils.getFormatShortNameFromFilename(output_raster)
 
-        if 0 < len(value_field_name):
+        # intermediate rasters are removed even if the processing fails
+        intermediates = IntermediateRasters()
+
+        try:
+
+            output_ds = create_output_raster(driver_name, output_raster, source_ds, len(bands),
+                                             gdal.GDT_Float32, no_data, intermediates)
+
+            tiles = list(raster_tiles(source_ds, self.TILE_SIZE))
+
+            window = polygons_window(polygons, source_ds)
+
+            raster_source = raster_layer.source()
+
+            # GDAL and OGR handles can not be shared between threads, every worker opens its own
+            worker_data = threading.local()
+            worker_lock = threading.Lock()
+
+            def process_tile(tile: Tuple[int, int, int, int]) -> List[np.ndarray]:
+
+                if not hasattr(worker_data, "source_ds"):
+                    worker_data.source_ds = gdal.Open(raster_source, gdal.GA_ReadOnly)
+
+                    with worker_lock:
+                        worker_data.polygons_ds = ogr.GetDriverByName("Memory").CopyDataSource(
+                            polygons_ds, "polygons")
+
+                tile_source_ds = worker_data.source_ds
+                tile_polygons = worker_data.polygons_ds.GetLayer(0)
+
+                x_off, y_off, width, height = tile
+
+                data = []
+
+                for band in bands:
+                    source_band = tile_source_ds.GetRasterBand(band)
+                    data.append(
+                        source_band.ReadAsArray(x_off, y_off, width, height,
+                                                buf_type=gdal.GDT_Float32))
+
+                # tiles without polygons are only copied, without rasterization
+                if not tiles_intersect(window, tile) or not polygons_in_tile(
+                        tile_polygons, tile_source_ds, x_off, y_off, width, height):
+                    return data
+
+                if 0 < len(value_field_name):
+
+                    # pixels outside of polygons stay NaN, inside polygons hold value of the field
+                    values = rasterize_tile(tile_polygons, tile_source_ds, x_off, y_off, width,
+                                            height, OGR_VALUE_FIELD)
+
+                    mask = ~np.isnan(values)
+
+                else:
+
+                    mask = rasterize_tile(tile_polygons, tile_source_ds, x_off, y_off, width,
+                                          height) == 1
+
+                    values = raster_new_value
+
+                # polygons are rasterized once per tile and applied to all bands
+                for i, band_data in enumerate(data):
+
+                    band_mask = mask
+
+                    if no_data[i] is not None:
+                        band_mask = mask & ~no_data_mask(band_data, no_data[i])
+
+                    data[i] = np.where(band_mask, values, band_data).astype(np.float32)
+
+                return data
+
+            def write_tile(tile: Tuple[int, int, int, int], data: List[np.ndarray]) -> None:
+
+                for i, band_data in enumerate(data):
+                    output_ds.GetRasterBand(i + 1).WriteArray(band_data, tile[0], tile[1])
+
+            total = 100.0 / len(tiles) if tiles else 0
 
-            temp_values_raster = QgsRasterLayer(raster_values)
+            processed = 0
 
-            multiple_value_raster = QgsRasterCalculatorEntry()
-            multiple_value_raster.ref = 'multiple_value_raster@1'
-            multiple_value_raster.raster = temp_values_raster
-            multiple_value_raster.bandNumber = 1
+            pending: Deque[Tuple[Future, Tuple[int, int, int, int]]] = deque()
 
-            raster_entries.append(multiple_value_raster)
+            with ThreadPoolExecutor(max_workers=threads) as executor:
 
-            expression = "({0} != {1}) * {2} + {3}".format(one_value_raster.ref, raster_new_value,
-                                                           org_raster.ref,
-                                                           multiple_value_raster.ref)
+                for tile in tiles:
 
-        calc = QgsRasterCalculator(expression, output_raster,
-                                   GdalUtils.getFormatShortNameFromFilename(output_raster),
-                                   raster_extent, raster_crs, int(raster_extent.width()),
-                                   int(raster_extent.height()), raster_entries,
-                                   context.transformContext())
+                    if feedback.isCanceled():
+                        break
 
-        calc.processCalculation()
+                    pending.append((executor.submit(process_tile, tile), tile))
+
+                    # tiles are written in order from this thread, only a few are kept in memory
+                    while pending and (len(pending) > 2 * threads or pending[0][0].done()):
+
+                        future, done_tile = pending.popleft()
+
+                        write_tile(done_tile, future.result())
+
+                        processed += 1
+                        feedback.setProgress(int(processed * total))
+
+                while pending:
+
+                    future, done_tile = pending.popleft()
+
+                    if feedback.isCanceled():
+                        future.cancel()
+                        continue
+
+                    write_tile(done_tile, future.result())
+
+                    processed += 1
+                    feedback.setProgress(int(processed * total))
+
+            output_ds = finish_output_raster(driver_name, output_raster, output_ds)
+
+        finally:
+
+            output_ds = None
+            intermediates.cleanup()
+
+        polygons_ds = None
+        source_ds = None
 
         return {self.OUTPUT_RASTER: output_raster}
 
     def createInstance(self):
         return ReplaceRasterValuesAlgorithm()
+
+
+def polygons_to_ogr(vector_layer: QgsVectorLayer, value_field_name: str,
+                    crs: QgsCoordinateReferenceSystem, context: QgsProcessingContext,
+                    feedback: QgsProcessingFeedback) -> ogr.DataSource:
+
+    polygons_ds = ogr.GetDriverByName("Memory").CreateDataSource("polygons")
+
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(crs.toWkt())
+
+    layer = polygons_ds.CreateLayer("polygons", srs, ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn(OGR_VALUE_FIELD, ogr.OFTReal))
+
+    request = QgsFeatureRequest().setDestinationCrs(crs, context.transformContext())
+
+    if 0 < len(value_field_name):
+        request.setSubsetOfAttributes([value_field_name], vector_layer.fields())
+    else:
+        request.setNoAttributes()
+
+    feature: QgsFeature
+
+    for feature in vector_layer.getFeatures(request):
+
+        if feedback.isCanceled():
+            break
+
+        if not feature.hasGeometry():
+            continue
+
+        ogr_feature = ogr.Feature(layer.GetLayerDefn())
+        ogr_feature.SetGeometry(ogr.CreateGeometryFromWkb(bytes(feature.geometry().asWkb())))
+
+        if 0 < len(value_field_name):
+
+            value = feature.attribute(value_field_name)
+
+            # same as gdal:rasterize, missing values are burned as 0
+            ogr_feature.SetField(OGR_VALUE_FIELD, value if value else 0)
+
+        layer.CreateFeature(ogr_feature)
+
+    return polygons_ds
+
+
+def raster_tiles(dataset: gdal.Dataset, tile_size: int) -> Iterator[Tuple[int, int, int, int]]:
+
+    block_width, block_height = dataset.GetRasterBand(1).GetBlockSize()
+
+    # tiles are aligned to blocks of the raster, so every block is read only once
+    tile_width = max(block_width, (tile_size // block_width) * block_width)
+    tile_height = max(block_height, (tile_size // block_height) * block_height)
+
+    for y_off in range(0, dataset.RasterYSize, tile_height):
+        for x_off in range(0, dataset.RasterXSize, tile_width):
+            yield (x_off, y_off, min(tile_width, dataset.RasterXSize - x_off),
+                   min(tile_height, dataset.RasterYSize - y_off))
+
+
+def rasterize_tile(layer: ogr.Layer,
+                   dataset: gdal.Dataset,
+                   x_off: int,
+                   y_off: int,
+                   width: int,
+                   height: int,
+                   attribute: Optional[str] = None) -> np.ndarray:
+
+    tile_gt = tile_geotransform(dataset.GetGeoTransform(), x_off, y_off)
+
+    data_type = gdal.GDT_Float64 if attribute else gdal.GDT_Byte
+
+    tile_ds = gdal.GetDriverByName("MEM").Create("", width, height, 1, data_type)
+    tile_ds.SetGeoTransform(tile_gt)
+    tile_ds.SetProjection(dataset.GetProjection())
+
+    if attribute:
+        tile_ds.GetRasterBand(1).Fill(np.nan)
+
+    # only polygons intersecting the tile are rasterized
+    layer.SetSpatialFilterRect(*tile_bounds(tile_gt, width, height))
+
+    if attribute:
+        gdal.RasterizeLayer(tile_ds, [1], layer, options=["ATTRIBUTE={}".format(attribute)])
+    else:
+        gdal.RasterizeLayer(tile_ds, [1], layer, burn_values=[1])
+
+    layer.SetSpatialFilter(None)
+
+    return tile_ds.GetRasterBand(1).ReadAsArray()
+
+
+def tile_geotransform(gt: Tuple[float, ...], x_off: int, y_off: int) -> Tuple[float, ...]:
+
+    return (gt[0] + x_off * gt[1] + y_off * gt[2], gt[1], gt[2],
+            gt[3] + x_off * gt[4] + y_off * gt[5], gt[4], gt[5])
+
+
+def polygons_window(layer: ogr.Layer,
+                    dataset: gdal.Dataset) -> Optional[Tuple[int, int, int, int]]:
+
+    if layer.GetFeatureCount() == 0:
+        return None
+
+    full_window = (0, 0, dataset.RasterXSize, dataset.RasterYSize)
+
+    gt = dataset.GetGeoTransform()
+
+    # window in pixels is only calculated for north up rasters
+    if gt[2] != 0 or gt[4] != 0:
+        return full_window
+
+    x_min, x_max, y_min, y_max = layer.GetExtent()
+
+    columns = sorted([(x_min - gt[0]) / gt[1], (x_max - gt[0]) / gt[1]])
+    rows = sorted([(y_min - gt[3]) / gt[5], (y_max - gt[3]) / gt[5]])
+
+    window = (max(0, math.floor(columns[0])), max(0, math.floor(rows[0])),
+              min(dataset.RasterXSize, math.ceil(columns[1])),
+              min(dataset.RasterYSize, math.ceil(rows[1])))
+
+    if window[0] >= window[2] or window[1] >= window[3]:
+        return None
+
+    return (window[0], window[1], window[2] - window[0], window[3] - window[1])
+
+
+def tiles_intersect(window: Optional[Tuple[int, int, int, int]],
+                    tile: Tuple[int, int, int, int]) -> bool:
+
+    if window is None:
+        return False
+
+    return (window[0] < tile[0] + tile[2] and tile[0] < window[0] + window[2] and
+            window[1] < tile[1] + tile[3] and tile[1] < window[1] + window[3])
+
+
+def polygons_in_tile(layer: ogr.Layer, dataset: gdal.Dataset, x_off: int, y_off: int,
+                     width: int, height: int) -> bool:
+
+    tile_gt = tile_geotransform(dataset.GetGeoTransform(), x_off, y_off)
+
+    layer.SetSpatialFilterRect(*tile_bounds(tile_gt, width, height))
+
+    count = layer.GetFeatureCount()
+
+    layer.SetSpatialFilter(None)
+
+    return 0 < count
+
+
+def tile_bounds(gt: Tuple[float, ...], width: int,
+                height: int) -> Tuple[float, float, float, float]:
+
+    corners = [(0, 0), (width, 0), (0, height), (width, height)]
+
+    corners_x = [gt[0] + x * gt[1] + y * gt[2] for x, y in corners]
+    corners_y = [gt[3] + x * gt[4] + y * gt[5] for x, y in corners]
+
+    return min(corners_x), min(corners_y), max(corners_x), max(corners_y)
+
+
+def no_data_mask(data: np.ndarray, no_data: float) -> np.ndarray:
+
+    if np.isnan(no_data):
+        return np.isnan(data)
+
+    return data == np.float32(no_data)
+
+
+def create_output_raster(driver_name: str, output_raster: str, source_ds: gdal.Dataset,
+                         band_count: int, data_type: int, no_data: List[Optional[float]],
+                         intermediates: 'IntermediateRasters') -> gdal.Dataset:
+
+    driver = gdal.GetDriverByName(driver_name)
+
+    if driver is None:
+        raise QgsProcessingException("Unknown raster format {}.".format(driver_name))
+
+    # formats without direct creation are assembled in intermediate raster and copied at the end
+    if driver.GetMetadataItem(gdal.DCAP_CREATE) != "YES":
+        output_ds = intermediates.create(source_ds.RasterXSize, source_ds.RasterYSize,
+                                         band_count, data_type)
+    else:
+        output_ds = driver.Create(output_raster, source_ds.RasterXSize, source_ds.RasterYSize,
+                                  band_count, data_type)
+
+    if output_ds is None:
+        raise QgsProcessingException("Could not create output raster {}.".format(output_raster))
+
+    output_ds.SetGeoTransform(source_ds.GetGeoTransform())
+    output_ds.SetProjection(source_ds.GetProjection())
+
+    for i, band_no_data in enumerate(no_data):
+        if band_no_data is not None:
+            output_ds.GetRasterBand(i + 1).SetNoDataValue(band_no_data)
+
+    return output_ds
+
+
+def finish_output_raster(driver_name: str, output_raster: str,
+                         output_ds: gdal.Dataset) -> gdal.Dataset:
+
+    if output_ds.GetDriver().ShortName != driver_name:
+        output_ds = gdal.GetDriverByName(driver_name).CreateCopy(output_raster, output_ds)
+
+    output_ds.FlushCache()
+
+    return output_ds
+
+
+class IntermediateRasters:
+
+    # scripts of the collection are loaded by QGIS one by one and can not import each other, so
+    # this class is copied unchanged into every script that needs it
+
+    # rasters up to this size in bytes are kept in memory, larger ones in temporary folder
+    MEMORY_LIMIT = 256 * 1024 * 1024
+
+    def __init__(self, memory_limit: int = MEMORY_LIMIT):
+
+        self.memory_limit = memory_limit
+        self.paths: List[str] = []
+
+    def path(self, size: int) -> str:
+
+        file_name = "intermediate_{}.tif".format(uuid.uuid4().hex)
+
+        if size <= self.memory_limit:
+            path = "/vsimem/{}".format(file_name)
+        else:
+            path = os.path.join(QgsProcessingUtils.tempFolder(), file_name)
+
+        self.paths.append(path)
+
+        return path
+
+    def create(self, width: int, height: int, band_count: int, data_type: int) -> gdal.Dataset:
+
+        size = width * height * band_count * gdal.GetDataTypeSize(data_type) // 8
+
+        path = self.path(size)
+
+        dataset = gdal.GetDriverByName("GTiff").Create(path, width, height, band_count,
+                                                       data_type,
+                                                       ["TILED=YES", "BIGTIFF=IF_SAFER"])
+
+        if dataset is None:
+            raise QgsProcessingException("Could not create intermediate raster {}.".format(path))
+
+        return dataset
+
+    def cleanup(self) -> None:
+
+        # datasets have to be closed before, otherwise the files can not be removed
+        for path in self.paths:
+            if gdal.VSIStatL(path) is not None:
+                gdal.GetDriverByName("GTiff").Delete(path)
+
+        self.paths = []
@@ -1,9 +1,17 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
 from qgis.PyQt.QtCore import QVariant, QCoreApplication
 from qgis.core import (QgsProcessing, QgsProcessingAlgorithm, QgsProcessingParameterFeatureSource,
                        QgsProcessingParameterField, QgsProcessingParameterBoolean, QgsVectorLayer,
-                       QgsFeature, QgsProcessingFeatureSourceDefinition)
-
-from qgis import processing
+                       QgsFeature, QgsFeatureRequest, QgsGeometry, QgsSpatialIndex,
+                       QgsProcessingFeedback, QgsProcessingParameterDefinition, QgsApplication,
+                       QgsProviderRegistry, QgsVectorDataProvider, QgsProcessingException,
+                       QgsProcessingParameterFeatureSink, QgsFeatureSink, QgsFields, QgsField,
+                       NULL)
 
 
 class SumPointsValueToNeighboringPolygonsProcessingAlgorithm(QgsProcessingAlgorithm):
@@ -13,6 +21,10 @@ class SumPointsValueToNeighboringPolygonsProcessingAlgorithm(QgsProcessingAlgori
     FIELD_ADD_TO = 'FIELDADDTO'
     FIELD_VALUE = 'FIELDVALUE'
     ZERO_VALUES = 'ZEROVALUES'
+    CACHE_NEIGHBORS = 'CACHENEIGHBORS'
+    OUTPUT = 'OUTPUT'
+
+    COUNT_FIELD_NAME = 'points_count'
 
     def createInstance(self):
         return SumPointsValueToNeighboringPolygonsProcessingAlgorithm()
@@ -30,7 +42,17 @@ class SumPointsValueToNeighboringPolygonsProcessingAlgorithm(QgsProcessingAlgori
         return 'vectortools'
 
     def shortHelpString(self):
-        return self.tr("Sum Points Value To Neighboring Polygons")
+        return self.tr("Sum Points Value To Neighboring Polygons\n\n"
+                       "Value of every point is added to polygons that touch or overlap the "
+                       "polygons containing the point. Polygons are read into a spatial index "
+                       "once and neighbors of every polygon are calculated before the points "
+                       "are processed.\n\n"
+                       "Neighbors of polygons from file based layers can be cached in the QGIS "
+                       "profile folder, the cache is reused while the layer source and its "
+                       "modification time do not change.\n\n"
+                       "If output polygon layer is set, the input polygon layer is not modified "
+                       "and the polygons are written to the output layer with the summed values "
+                       "and number of points that contributed to them.")
 
     def initAlgorithm(self, config=None):
 
@@ -56,6 +78,20 @@ class SumPointsValueToNeighboringPolygonsProcessingAlgorithm(QgsProcessingAlgori
                 self.ZERO_VALUES,
                 self.tr("Should the values that are added to be set to 0 before calculation?")))
 
+        cache_param = QgsProcessingParameterBoolean(
+            self.CACHE_NEIGHBORS,
+            self.tr('Cache neighbors of polygons between runs'),
+            defaultValue=True)
+        cache_param.setFlags(cache_param.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(cache_param)
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(self.OUTPUT,
+                                              self.tr('Output polygon layer'),
+                                              QgsProcessing.TypeVectorPolygon,
+                                              optional=True,
+                                              createByDefault=False))
+
     def processAlgorithm(self, parameters, context, feedback):
 
         points: QgsVectorLayer = self.parameterAsVectorLayer(parameters, self.INPUT_POINTS,
@@ -70,63 +106,283 @@ class SumPointsValueToNeighboringPolygonsProcessingAlgorithm(QgsProcessingAlgori
 
         zero_values: bool = self.parameterAsBool(parameters, self.ZERO_VALUES, context)
 
-        total = 100.0 / points.dataProvider().featureCount() if points.dataProvider().featureCount(
-        ) else 0
+        cache_neighbors: bool = self.parameterAsBool(parameters, self.CACHE_NEIGHBORS, context)
 
-        polygons.startEditing()
+        field_add_to_index = polygons.fields().lookupField(field_add_to)
 
-        feature_polygon: QgsFeature
+        # polygon layer can already have the field, e.g. output of previous run
+        count_field_name = unique_field_name(polygons.fields(), self.COUNT_FIELD_NAME)
 
-        if zero_values:
+        output_fields = QgsFields(polygons.fields())
+        output_fields.append(QgsField(count_field_name, QVariant.Int))
+
+        (sink, sink_dest) = self.parameterAsSink(parameters, self.OUTPUT, context, output_fields,
+                                                 polygons.wkbType(), polygons.crs())
+
+        # without output layer the values are written into the polygon layer
+        if sink is None:
+
+            capabilities = polygons.dataProvider().capabilities()
+
+            if not capabilities & QgsVectorDataProvider.ChangeAttributeValues:
+                raise QgsProcessingException(
+                    self.tr(
+                        'Data provider of polygon layer does not support changing attributes.'))
+
+            if polygons.isEditable():
+                raise QgsProcessingException(
+                    self.tr('Polygon layer is in edit mode, save or discard the edits first.'))
+
+        polygon_index, polygon_geometries = polygons_spatial_index(polygons, feedback)
 
-            for feature_polygon in polygons.getFeatures():
+        cache_file = neighbors_cache_file(polygons) if cache_neighbors else None
 
-                polygons.changeAttributeValue(feature_polygon.id(),
-                                              feature_polygon.fieldNameIndex(field_add_to), 0)
+        neighbors = load_neighbors(cache_file) if cache_file else None
+
+        if neighbors is None or set(neighbors.keys()) != set(polygon_geometries.keys()):
+
+            neighbors = polygon_neighbors(polygon_index, polygon_geometries, feedback)
+
+            if cache_file and not feedback.isCanceled():
+                save_neighbors(cache_file, neighbors)
+
+        else:
+
+            feedback.pushInfo(self.tr('Using cached neighbors of polygons.'))
+
+        sums: Dict[int, float] = {}
+        counts: Dict[int, int] = {}
+
+        total = 100.0 / points.featureCount() if points.featureCount() else 0
+
+        request = QgsFeatureRequest().setSubsetOfAttributes([field_values], points.fields())
+        request.setDestinationCrs(polygons.crs(), context.transformContext())
 
         feature_point: QgsFeature
 
-        for number, feature_point in enumerate(points.getFeatures()):
+        for number, feature_point in enumerate(points.getFeatures(request)):
 
-            points.selectByExpression("$id = {}".format(feature_point.id()))
+            if feedback.isCanceled():
+                break
 
             value_to_add = feature_point.attribute(field_values)
 
-            processing.run(
-                "native:selectbylocation", {
-                    'INPUT':
-                        polygons,
-                    'PREDICATE': [1],
-                    'INTERSECT':
-                        QgsProcessingFeatureSourceDefinition(points.name(),
-                                                             selectedFeaturesOnly=True),
-                    'METHOD':
-                        0
-                })
-
-            processing.run(
-                "native:selectbylocation", {
-                    'INPUT':
-                        polygons,
-                    'PREDICATE': [4, 5],
-                    'INTERSECT':
-                        QgsProcessingFeatureSourceDefinition(polygons.name(),
-                                                             selectedFeaturesOnly=True),
-                    'METHOD':
-                        0
-                })
-
-            for feature_polygon in polygons.getSelectedFeatures():
-
-                polygons.changeAttributeValue(
-                    feature_polygon.id(), feature_polygon.fieldNameIndex(field_add_to),
-                    feature_polygon.attribute(field_add_to) + value_to_add)
+            if value_to_add is None or value_to_add == NULL or not feature_point.hasGeometry():
+                continue
+
+            point_geometry = feature_point.geometry()
+
+            containing_polygons = [
+                fid for fid in polygon_index.intersects(point_geometry.boundingBox())
+                if polygon_geometries[fid].contains(point_geometry)
+            ]
+
+            # values are added to polygons touching or overlapping the polygons with the point
+            polygons_to_add_to: Set[int] = set()
+
+            for fid in containing_polygons:
+                polygons_to_add_to.update(neighbors[fid])
+
+            for fid in polygons_to_add_to:
+                sums[fid] = sums.get(fid, 0) + value_to_add
+                counts[fid] = counts.get(fid, 0) + 1
 
             feedback.setProgress(int(number * total))
 
-        polygons.commitChanges()
+        if feedback.isCanceled():
+            return {}
+
+        if sink is not None:
+
+            total = 100.0 / polygons.featureCount() if polygons.featureCount() else 0
+
+            feature_polygon: QgsFeature
+
+            for number, feature_polygon in enumerate(polygons.getFeatures()):
+
+                if feedback.isCanceled():
+                    break
+
+                output_feature = QgsFeature(output_fields)
+                output_feature.setGeometry(feature_polygon.geometry())
+                output_feature.setAttributes(feature_polygon.attributes() +
+                                             [counts.get(feature_polygon.id(), 0)])
+
+                value = feature_polygon.attribute(field_add_to)
+
+                if zero_values or value is None or value == NULL:
+                    value = 0
+
+                if zero_values or feature_polygon.id() in sums:
+                    output_feature.setAttribute(field_add_to_index,
+                                                value + sums.get(feature_polygon.id(), 0))
+
+                sink.addFeature(output_feature, QgsFeatureSink.FastInsert)
+
+                feedback.setProgress(int(number * total))
+
+            return {self.OUTPUT: sink_dest}
+
+        new_values: Dict[int, float] = {}
+
+        if zero_values:
+
+            for fid in polygons.allFeatureIds():
+                new_values[fid] = sums.get(fid, 0)
+
+        else:
+
+            request = QgsFeatureRequest().setFilterFids(list(sums.keys()))
+            request.setSubsetOfAttributes([field_add_to], polygons.fields())
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+
+            feature_polygon: QgsFeature
+
+            for feature_polygon in polygons.getFeatures(request):
+
+                value = feature_polygon.attribute(field_add_to)
+
+                if value is None or value == NULL:
+                    value = 0
+
+                new_values[feature_polygon.id()] = value + sums[feature_polygon.id()]
+
+        # values are written directly by the provider, bypassing edit buffer and undo stack, in a
+        # single call, so that the provider applies all of them or none
+        attribute_changes = {fid: {field_add_to_index: value} for fid, value in new_values.items()}
+
+        if not polygons.dataProvider().changeAttributeValues(attribute_changes):
+            raise QgsProcessingException(
+                self.tr('Could not write values to polygon layer: {}').format(
+                    polygons.dataProvider().lastError()))
 
-        return {None}
+        # values were written directly to the provider, layer and open attribute tables are
+        # notified by reload
+        polygons.reload()
+        polygons.triggerRepaint()
+
+        # only attributes were changed, so the neighbors are stored for the new modification time
+        if cache_file:
+
+            new_cache_file = neighbors_cache_file(polygons)
+
+            if new_cache_file and new_cache_file != cache_file:
+                save_neighbors(new_cache_file, neighbors)
+                cache_file.unlink(missing_ok=True)
+
+        return {}
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
+
+
+def unique_field_name(fields: QgsFields, name: str) -> str:
+
+    unique_name = name
+    number = 1
+
+    # lookupField also matches names differing only in case, as most formats do
+    while fields.lookupField(unique_name) >= 0:
+        number += 1
+        unique_name = '{}_{}'.format(name, number)
+
+    return unique_name
+
+
+def polygons_spatial_index(
+        polygons: QgsVectorLayer,
+        feedback: QgsProcessingFeedback) -> Tuple[QgsSpatialIndex, Dict[int, QgsGeometry]]:
+
+    index = QgsSpatialIndex()
+    geometries: Dict[int, QgsGeometry] = {}
+
+    feature: QgsFeature
+
+    for feature in polygons.getFeatures(QgsFeatureRequest().setNoAttributes()):
+
+        if feedback.isCanceled():
+            break
+
+        if not feature.hasGeometry():
+            continue
+
+        geometries[feature.id()] = feature.geometry()
+        index.addFeature(feature.id(), feature.geometry().boundingBox())
+
+    return index, geometries
+
+
+def polygon_neighbors(index: QgsSpatialIndex, geometries: Dict[int, QgsGeometry],
+                      feedback: QgsProcessingFeedback) -> Dict[int, Set[int]]:
+
+    neighbors: Dict[int, Set[int]] = {fid: set() for fid in geometries}
+
+    for fid, geometry in geometries.items():
+
+        if feedback.isCanceled():
+            break
+
+        engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+        engine.prepareGeometry()
+
+        for other_fid in index.intersects(geometry.boundingBox()):
+
+            # relation is symmetric, so each pair is tested only once
+            if other_fid <= fid:
+                continue
+
+            other_geometry = geometries[other_fid].constGet()
+
+            if engine.touches(other_geometry) or engine.overlaps(other_geometry):
+                neighbors[fid].add(other_fid)
+                neighbors[other_fid].add(fid)
+
+    return neighbors
+
+
+def neighbors_cache_file(polygons: QgsVectorLayer) -> Optional[Path]:
+
+    if polygons.isModified():
+        return None
+
+    uri = QgsProviderRegistry.instance().decodeUri(polygons.providerType(), polygons.source())
+
+    path = uri.get('path')
+
+    if not path or not os.path.isfile(path):
+        return None
+
+    key = "{}|{}|{}".format(polygons.source(), os.path.getmtime(path), polygons.featureCount())
+
+    cache_folder = Path(QgsApplication.qgisSettingsDirPath()) / "cache" / "polygon_neighbors"
+
+    return cache_folder / "{}.json".format(hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def load_neighbors(cache_file: Path) -> Optional[Dict[int, Set[int]]]:
+
+    try:
+        with open(cache_file, "r", encoding="utf-8") as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    return {int(fid): set(fid_neighbors) for fid, fid_neighbors in data.items()}
+
+
+def save_neighbors(cache_file: Path, neighbors: Dict[int, Set[int]]) -> None:
+
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+        temp_file = cache_file.with_suffix(".tmp")
+
+        data = {str(fid): sorted(fid_neighbors) for fid, fid_neighbors in neighbors.items()}
+
+        with open(temp_file, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+
+        os.replace(temp_file, cache_file)
+
+    except OSError:
+        pass
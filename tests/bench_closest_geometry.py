@@ -0,0 +1,110 @@
+"""Benchmark of nearest geometry search through spatial index against brute force scan.
+
+Not collected by default, run explicitly:
+
+    python -m pytest -q -s tests/bench_closest_geometry.py
+"""
+import random
+import time
+
+import pytest
+
+pytest.importorskip('qgis.core')
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import QgsFeature, QgsField, QgsFields, QgsGeometry, QgsGeometryUtils, QgsPoint
+
+from ClosestGeometryAlgorithm import NearestGeometryIndex
+
+POINTS = 2000
+
+# numbers of synthetic lines in the closest feature layer
+TARGETS = [1000, 10000]
+
+
+class FeatureSource:
+
+    def __init__(self, geometries):
+
+        self._fields = QgsFields()
+        self._fields.append(QgsField('id', QVariant.Int))
+
+        self._features = []
+
+        for i, geometry in enumerate(geometries):
+            feature = QgsFeature(self._fields)
+            feature.setGeometry(geometry)
+            feature.setAttribute('id', i)
+            self._features.append(feature)
+
+    def fields(self):
+        return self._fields
+
+    def getFeatures(self, request=None):
+        return iter(self._features)
+
+
+def random_lines(rng: random.Random, count: int):
+
+    lines = []
+
+    for _ in range(count):
+
+        x, y = rng.uniform(0, 10000), rng.uniform(0, 10000)
+
+        vertices = [QgsPoint(x, y)]
+
+        for _ in range(rng.randint(1, 10)):
+            x += rng.uniform(-50, 50)
+            y += rng.uniform(-50, 50)
+            vertices.append(QgsPoint(x, y))
+
+        lines.append(QgsGeometry.fromPolyline(vertices))
+
+    return lines
+
+
+def brute_force(geometries, point: QgsPoint):
+
+    # exhaustive scan as done before the spatial index was used
+    best = None
+
+    for position, geometry in enumerate(geometries):
+
+        closest = QgsGeometryUtils.closestPoint(geometry.constGet(), point)
+        distance = point.distance(closest)
+
+        if best is None or distance < best[1]:
+            best = (position, distance)
+
+    return best
+
+
+@pytest.mark.parametrize('targets', TARGETS)
+def test_index_against_brute_force(targets):
+
+    rng = random.Random(targets)
+
+    geometries = random_lines(rng, targets)
+    points = [QgsPoint(rng.uniform(0, 10000), rng.uniform(0, 10000)) for _ in range(POINTS)]
+
+    start = time.perf_counter()
+    index = NearestGeometryIndex(FeatureSource(geometries), 'id')
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed = [result[0] for result in index.nearest_many(points)]
+    index_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scanned = [brute_force(geometries, point) for point in points]
+    brute_force_time = time.perf_counter() - start
+
+    print('\n{} points, {} lines: index build {:.3f} s, index search {:.3f} s, '
+          'brute force {:.3f} s, speedup {:.1f}x'.format(
+              POINTS, targets, build_time, index_time, brute_force_time,
+              brute_force_time / (build_time + index_time)))
+
+    # positions can differ only for targets at the same distance
+    for (_, distance, _), (_, expected_distance) in zip(indexed, scanned):
+        assert distance == pytest.approx(expected_distance)
@@ -0,0 +1,130 @@
+"""Benchmark of clipping a large synthetic DEM with gdalwarp and in process engines.
+
+Not collected by default, run explicitly (size of the DEM in pixels along each side can be set
+by BENCH_DEM_SIZE):
+
+    BENCH_DEM_SIZE=20000 python -m pytest -q -s tests/bench_raster_clip_shape.py
+"""
+import os
+import time
+
+import pytest
+
+pytest.importorskip('qgis.core')
+pytest.importorskip('processing')
+np = pytest.importorskip('numpy')
+
+from osgeo import gdal, ogr, osr
+
+from qgis.core import QgsProcessingContext, QgsProcessingFeedback
+
+from RasterClipShape import ClipRasterByExtent
+
+DEM_SIZE = int(os.environ.get('BENCH_DEM_SIZE', '10000'))
+
+PIXEL_SIZE = 1.0
+
+CONFIGURATIONS = [
+    ('gdalwarp', {'ENGINE': 0}),
+    ('gdalwarp, 4 warp threads, 512 MB', {'ENGINE': 0, 'WARP_THREADS': 4, 'WARP_MEMORY': 512}),
+    ('in process', {'ENGINE': 1}),
+    ('in process, 4 warp threads, 512 MB, 1024 MB cache', {
+        'ENGINE': 1,
+        'WARP_THREADS': 4,
+        'WARP_MEMORY': 512,
+        'CACHE_MAX': 1024
+    }),
+    ('in process, tiled DEFLATE', {'ENGINE': 1, 'OUTPUT_PRESET': 2}),
+]
+
+
+def spatial_reference() -> osr.SpatialReference:
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32633)
+
+    return srs
+
+
+@pytest.fixture(scope='module')
+def dem(tmp_path_factory):
+
+    path = str(tmp_path_factory.mktemp('dem') / 'dem.tif')
+
+    dataset = gdal.GetDriverByName('GTiff').Create(
+        path, DEM_SIZE, DEM_SIZE, 1, gdal.GDT_Float32,
+        ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    dataset.SetGeoTransform((500000, PIXEL_SIZE, 0, 5500000, 0, -PIXEL_SIZE))
+    dataset.SetProjection(spatial_reference().ExportToWkt())
+
+    band = dataset.GetRasterBand(1)
+
+    columns = np.arange(DEM_SIZE, dtype=np.float32)
+
+    # smooth synthetic terrain written in strips of rows
+    for y_off in range(0, DEM_SIZE, 1024):
+        rows = np.arange(y_off, min(y_off + 1024, DEM_SIZE), dtype=np.float32)[:, np.newaxis]
+        band.WriteArray(300 + 50 * np.sin(columns / 500) * np.cos(rows / 700), 0, y_off)
+
+    dataset = None
+
+    return path
+
+
+@pytest.fixture(scope='module')
+def clip_layer(tmp_path_factory):
+
+    path = str(tmp_path_factory.mktemp('clip') / 'clip.gpkg')
+
+    clip_ds = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+    layer = clip_ds.CreateLayer('clip', spatial_reference(), ogr.wkbPolygon)
+
+    # polygon over most of the DEM, with vertices off the pixel grid
+    size = DEM_SIZE * PIXEL_SIZE
+
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+
+    for x, y in [(0.1, 0.2), (0.9, 0.05), (0.95, 0.8), (0.5, 0.97), (0.03, 0.6), (0.1, 0.2)]:
+        ring.AddPoint_2D(500000 + x * size, 5500000 - y * size)
+
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    polygon.AddGeometry(ring)
+
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(polygon)
+    layer.CreateFeature(feature)
+
+    clip_ds = None
+
+    return path
+
+
+@pytest.mark.parametrize('name, configuration', CONFIGURATIONS,
+                         ids=[name for name, _ in CONFIGURATIONS])
+def test_clip_dem(dem, clip_layer, tmp_path, name, configuration):
+
+    algorithm = ClipRasterByExtent()
+    algorithm.initAlgorithm()
+
+    parameters = {
+        'INPUT': dem,
+        'CLIP_LAYER': clip_layer,
+        'OUTPUT': str(tmp_path / 'clipped.tif'),
+    }
+    parameters.update(configuration)
+
+    cache_max = gdal.GetCacheMax()
+
+    start = time.perf_counter()
+    algorithm.processAlgorithm(parameters, QgsProcessingContext(), QgsProcessingFeedback())
+    elapsed = time.perf_counter() - start
+
+    print('\n{0}x{0} DEM, {1}: {2:.2f} s'.format(DEM_SIZE, name, elapsed))
+
+    # block cache of the process is not changed by clipping
+    assert gdal.GetCacheMax() == cache_max
+
+    clipped_ds = gdal.Open(str(tmp_path / 'clipped.tif'))
+
+    assert clipped_ds is not None
+    assert 0 < clipped_ds.RasterXSize <= DEM_SIZE
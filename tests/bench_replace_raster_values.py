@@ -0,0 +1,137 @@
+"""Benchmark of replacing raster values with one and more threads on a large synthetic raster.
+
+Not collected by default, run explicitly (raster size in pixels along each side, number of bands
+and threads can be set by BENCH_RASTER_SIZE, BENCH_RASTER_BANDS and BENCH_THREADS):
+
+    BENCH_RASTER_SIZE=25000 python -m pytest -q -s tests/bench_replace_raster_values.py
+"""
+import os
+import random
+import time
+
+import pytest
+
+pytest.importorskip('qgis.core')
+pytest.importorskip('processing')
+np = pytest.importorskip('numpy')
+
+from osgeo import gdal, ogr, osr
+
+from qgis.core import QgsProcessingContext, QgsProcessingFeedback
+
+from ReplaceRasterValues import ReplaceRasterValuesAlgorithm
+
+# default 3 bands of 14000 x 14000 Float32 pixels, about 2.3 GB
+RASTER_SIZE = int(os.environ.get('BENCH_RASTER_SIZE', '14000'))
+RASTER_BANDS = int(os.environ.get('BENCH_RASTER_BANDS', '3'))
+
+THREADS = int(os.environ.get('BENCH_THREADS', str(os.cpu_count() or 4)))
+
+POLYGONS = 2000
+
+
+def spatial_reference() -> osr.SpatialReference:
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32633)
+
+    return srs
+
+
+@pytest.fixture(scope='module')
+def raster(tmp_path_factory):
+
+    path = str(tmp_path_factory.mktemp('raster') / 'raster.tif')
+
+    dataset = gdal.GetDriverByName('GTiff').Create(path, RASTER_SIZE, RASTER_SIZE, RASTER_BANDS,
+                                                   gdal.GDT_Float32,
+                                                   ['TILED=YES', 'BIGTIFF=YES'])
+    dataset.SetGeoTransform((500000, 1, 0, 5500000, 0, -1))
+    dataset.SetProjection(spatial_reference().ExportToWkt())
+
+    columns = np.arange(RASTER_SIZE, dtype=np.float32)
+
+    for band in range(1, RASTER_BANDS + 1):
+        for y_off in range(0, RASTER_SIZE, 1024):
+            rows = np.arange(y_off, min(y_off + 1024, RASTER_SIZE),
+                             dtype=np.float32)[:, np.newaxis]
+            dataset.GetRasterBand(band).WriteArray(band * (columns + rows), 0, y_off)
+
+    dataset = None
+
+    return path
+
+
+@pytest.fixture(scope='module')
+def polygons(tmp_path_factory):
+
+    path = str(tmp_path_factory.mktemp('polygons') / 'polygons.gpkg')
+
+    polygons_ds = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+    layer = polygons_ds.CreateLayer('polygons', spatial_reference(), ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('addition', ogr.OFTReal))
+
+    rng = random.Random(42)
+
+    layer.StartTransaction()
+
+    # squares scattered over the raster, so that some tiles are only copied
+    for _ in range(POLYGONS):
+
+        size = rng.uniform(10, RASTER_SIZE / 50)
+        x = 500000 + rng.uniform(0, RASTER_SIZE - size)
+        y = 5500000 - rng.uniform(0, RASTER_SIZE - size)
+
+        feature = ogr.Feature(layer.GetLayerDefn())
+        wkt = 'POLYGON (({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(
+            x, y, x + size, y - size)
+
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(wkt))
+        feature.SetField('addition', rng.uniform(-100, 100))
+        layer.CreateFeature(feature)
+
+    layer.CommitTransaction()
+
+    polygons_ds = None
+
+    return path
+
+
+def replace_values(raster: str, polygons: str, output: str, threads: int) -> float:
+
+    algorithm = ReplaceRasterValuesAlgorithm()
+    algorithm.initAlgorithm()
+
+    parameters = {
+        'RasterLayer': raster,
+        'VectorLayer': polygons,
+        'ValueField': 'addition',
+        'Threads': threads,
+        'OutputRaster': output,
+    }
+
+    start = time.perf_counter()
+    algorithm.processAlgorithm(parameters, QgsProcessingContext(), QgsProcessingFeedback())
+
+    return time.perf_counter() - start
+
+
+def test_threads(raster, polygons, tmp_path):
+
+    single_output = str(tmp_path / 'single.tif')
+    threaded_output = str(tmp_path / 'threaded.tif')
+
+    single_time = replace_values(raster, polygons, single_output, 1)
+    threaded_time = replace_values(raster, polygons, threaded_output, THREADS)
+
+    print('\n{0} bands of {1}x{1} pixels: 1 thread {2:.2f} s, {3} threads {4:.2f} s, '
+          'speedup {5:.1f}x'.format(RASTER_BANDS, RASTER_SIZE, single_time, THREADS,
+                                    threaded_time, single_time / threaded_time))
+
+    single_ds = gdal.Open(single_output)
+    threaded_ds = gdal.Open(threaded_output)
+
+    # tiles are written in order, so the outputs are identical
+    for band in range(1, RASTER_BANDS + 1):
+        assert (single_ds.GetRasterBand(band).Checksum() ==
+                threaded_ds.GetRasterBand(band).Checksum())
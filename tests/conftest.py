@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# algorithms are standalone scripts of the collection, not an installed package
+sys.path.insert(
+    0, os.path.join(os.path.dirname(__file__), '..', 'collections', 'python_tools', 'processing'))
+
+
+@pytest.fixture(scope='session', autouse=True)
+def qgis_application():
+
+    # providers (memory layers) are only available in initialized application
+    qgis_core = pytest.importorskip('qgis.core')
+
+    application = qgis_core.QgsApplication([], False)
+    application.initQgis()
+
+    yield application
+
+    application.exitQgis()
@@ -0,0 +1,170 @@
+import math
+import random
+
+import pytest
+
+pytest.importorskip('qgis.core')
+pytest.importorskip('numpy')
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import QgsFeature, QgsField, QgsFields, QgsGeometry, QgsGeometryUtils, QgsPoint
+
+from ClosestGeometryAlgorithm import NumpyNearestGeometryIndex
+
+GEOMETRIES = [
+    'Point (5 5)',
+    'MultiPoint ((0 0), (10 0), (10 0))',
+    'LineString (0 0, 10 0, 10 10)',
+    # repeated vertices give zero length segments
+    'LineString (20 20, 20 20, 30 25, 30 25, 40 20)',
+    'MultiLineString ((0 20, 5 25), (6 25, 12 20, 0 20))',
+    'Polygon ((0 0, 10 0, 10 10, 0 10, 0 0))',
+    'Polygon ((0 0, 20 0, 20 20, 0 20, 0 0), (5 5, 15 5, 15 15, 5 15, 5 5))',
+    'MultiPolygon (((30 30, 40 30, 35 40, 30 30)), ((50 50, 60 50, 60 60, 50 60, 50 50)))',
+    'LineString (0.1 0.2, 0.30000000000000004 0.7, 1e-9 1e-9)',
+]
+
+
+def random_polygon(rng: random.Random, vertices: int) -> str:
+
+    center_x, center_y = rng.uniform(-100, 100), rng.uniform(-100, 100)
+
+    angles = sorted(rng.uniform(0, 6.283185307179586) for _ in range(vertices))
+
+    coords = [(center_x + rng.uniform(1, 20) * math.cos(angle),
+               center_y + rng.uniform(1, 20) * math.sin(angle)) for angle in angles]
+    coords.append(coords[0])
+
+    return 'Polygon (({}))'.format(', '.join('{!r} {!r}'.format(x, y) for x, y in coords))
+
+
+class FeatureSource:
+
+    # targets of mixed geometry types, which a single vector layer can not hold
+    def __init__(self, geometries):
+
+        self._fields = QgsFields()
+        self._fields.append(QgsField('id', QVariant.Int))
+
+        self._features = []
+
+        for i, wkt in enumerate(geometries):
+            feature = QgsFeature(self._fields)
+            feature.setGeometry(QgsGeometry.fromWkt(wkt))
+            feature.setAttribute('id', i)
+            self._features.append(feature)
+
+    def fields(self):
+        return self._fields
+
+    def getFeatures(self, request=None):
+        return iter(self._features)
+
+
+def make_index(geometries):
+    return NumpyNearestGeometryIndex(FeatureSource(geometries), 'id')
+
+
+def sample_points(rng: random.Random, geometries):
+
+    points = [QgsPoint(rng.uniform(-120, 120), rng.uniform(-120, 120)) for _ in range(200)]
+
+    # points lying exactly on vertices and segments of targets
+    for wkt in geometries:
+        for vertex in QgsGeometry.fromWkt(wkt).vertices():
+            points.append(QgsPoint(vertex.x(), vertex.y()))
+
+    points.append(QgsPoint(5, 0))
+    points.append(QgsPoint(10, 2.5))
+
+    return points
+
+
+def expected(wkt: str, point: QgsPoint):
+
+    closest = QgsGeometryUtils.closestPoint(QgsGeometry.fromWkt(wkt).constGet(), point)
+
+    return point.distance(closest), closest.x(), closest.y()
+
+
+@pytest.fixture
+def rng():
+    return random.Random(42)
+
+
+@pytest.mark.parametrize('geometries', [
+    GEOMETRIES,
+    [random_polygon(random.Random(seed), 3 + seed * 7) for seed in range(20)],
+])
+def test_numpy_engine_matches_qgis_closest_point(rng, geometries):
+
+    index = make_index(geometries)
+
+    points = sample_points(rng, geometries)
+
+    pairs = [(i, position) for i in range(len(points)) for position in range(len(geometries))]
+
+    measurements = index.measure(points, pairs)
+
+    for (i, position), (distance, closest) in zip(pairs, measurements):
+
+        expected_distance, expected_x, expected_y = expected(geometries[position], points[i])
+
+        # tolerance only covers floating point contraction differences of compiled code
+        assert closest.x() == pytest.approx(expected_x, rel=1e-12, abs=1e-12), points[i].asWkt()
+        assert closest.y() == pytest.approx(expected_y, rel=1e-12, abs=1e-12), points[i].asWkt()
+        assert distance == pytest.approx(expected_distance, rel=1e-12, abs=1e-12)
+
+
+def test_batches_give_same_results(rng):
+
+    geometries = [random_polygon(random.Random(seed), 50) for seed in range(10)]
+
+    index = make_index(geometries)
+
+    points = sample_points(rng, geometries)
+
+    pairs = [(i, position) for i in range(len(points)) for position in range(len(geometries))]
+
+    whole = index.measure(points, pairs)
+
+    index.BATCH_SEGMENTS = 120
+
+    batches = list(index.segment_batches(pairs, list(range(len(pairs)))))
+
+    assert [j for batch in batches for j in batch] == list(range(len(pairs)))
+    assert all(
+        sum(int(index.offsets[pairs[j][1] + 1] - index.offsets[pairs[j][1]])
+            for j in batch) <= 120 for batch in batches)
+
+    batched = index.measure(points, pairs)
+
+    assert [(distance, closest.x(), closest.y()) for distance, closest in whole
+            ] == [(distance, closest.x(), closest.y()) for distance, closest in batched]
+
+
+def test_target_larger_than_batch_forms_own_batch():
+
+    index = make_index([random_polygon(random.Random(1), 200), 'Point (0 0)'])
+
+    index.BATCH_SEGMENTS = 10
+
+    pairs = [(0, 0), (0, 1), (1, 0)]
+
+    assert list(index.segment_batches(pairs, [0, 1, 2])) == [[0], [1], [2]]
+
+
+def test_views_have_own_bulk_loaded_index(rng):
+
+    index = make_index(GEOMETRIES)
+
+    first = index.view()
+    second = index.view()
+
+    # the first worker reuses the index built with the targets
+    assert first is index
+    assert second.index is not index.index
+
+    points = sample_points(rng, GEOMETRIES)
+
+    assert second.nearest_many(points, 3) == index.nearest_many(points, 3)
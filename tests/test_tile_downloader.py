@@ -0,0 +1,181 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip('qgis.core')
+pytest.importorskip('processing')
+
+from qgis.core import QgsProcessingException
+
+from DownloadCuzkElevationData import TileDownloader
+
+DATA = os.urandom(300000)
+
+
+class TileHandler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1 keeps the connection alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    requests = []
+
+    def do_GET(self):
+
+        byte_range = self.headers.get('Range')
+
+        self.requests.append((self.path, byte_range, self.client_address[1]))
+
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', '/tile.zip')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.path != '/tile.zip':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if byte_range:
+
+            start = int(byte_range[len('bytes='):-1])
+
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(len(DATA)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            body = DATA[start:]
+
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {}-{}/{}'.format(start, len(DATA) - 1, len(DATA)))
+
+        else:
+
+            body = DATA
+
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Feedback:
+
+    def __init__(self, canceled=False):
+        self.canceled = canceled
+
+    def isCanceled(self):
+        return self.canceled
+
+
+@pytest.fixture
+def server(monkeypatch):
+
+    # requests to the local server do not go through a proxy of the environment
+    for name in ('http_proxy', 'HTTP_PROXY', 'https_proxy', 'HTTPS_PROXY'):
+        monkeypatch.delenv(name, raising=False)
+
+    TileHandler.requests = []
+
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), TileHandler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    yield 'http://127.0.0.1:{}'.format(http_server.server_port)
+
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def test_download_reuses_connection(server, tmp_path):
+
+    downloader = TileDownloader()
+
+    downloader.download(server + '/tile.zip', tmp_path / 'first.zip')
+    downloader.download(server + '/tile.zip', tmp_path / 'second.zip')
+
+    assert (tmp_path / 'first.zip').read_bytes() == DATA
+    assert (tmp_path / 'second.zip').read_bytes() == DATA
+
+    # both requests came from the same client port
+    assert len({port for _, _, port in TileHandler.requests}) == 1
+
+
+def test_redirect(server, tmp_path):
+
+    TileDownloader().download(server + '/redirect', tmp_path / 'tile.zip')
+
+    assert (tmp_path / 'tile.zip').read_bytes() == DATA
+    assert [path for path, _, _ in TileHandler.requests] == ['/redirect', '/tile.zip']
+
+
+def test_not_found(server, tmp_path):
+
+    with pytest.raises(QgsProcessingException, match='HTTP status 404'):
+        TileDownloader().download(server + '/missing.zip', tmp_path / 'tile.zip')
+
+    assert not (tmp_path / 'tile.zip').exists()
+
+
+def test_resume(server, tmp_path):
+
+    path = tmp_path / 'tile.zip'
+    path.write_bytes(DATA[:1000])
+
+    TileDownloader().download(server + '/tile.zip', path)
+
+    assert path.read_bytes() == DATA
+    assert TileHandler.requests[0][1] == 'bytes=1000-'
+
+
+def test_range_of_complete_file(server, tmp_path):
+
+    path = tmp_path / 'tile.zip'
+    path.write_bytes(DATA)
+
+    TileDownloader().download(server + '/tile.zip', path)
+
+    assert path.read_bytes() == DATA
+    assert len(TileHandler.requests) == 1
+
+
+def test_range_of_mismatched_file(server, tmp_path):
+
+    # partial file larger than the file on server is downloaded again
+    path = tmp_path / 'tile.zip'
+    path.write_bytes(DATA + b'extra')
+
+    TileDownloader().download(server + '/tile.zip', path)
+
+    assert path.read_bytes() == DATA
+    assert [byte_range for _, byte_range, _ in TileHandler.requests] == [
+        'bytes={}-'.format(len(DATA) + 5), None
+    ]
+
+
+def test_stream(server):
+
+    downloader = TileDownloader()
+
+    assert downloader.stream(server + '/redirect', lambda response: response.read(10)) == DATA[:10]
+
+    # rest of the response is read, so the connection is reused
+    assert downloader.stream(server + '/tile.zip', lambda response: response.read()) == DATA
+    assert len({port for _, _, port in TileHandler.requests}) == 1
+
+
+def test_canceled_download(server, tmp_path):
+
+    with pytest.raises(QgsProcessingException, match='canceled'):
+        TileDownloader().download(server + '/tile.zip', tmp_path / 'tile.zip', Feedback(True))
@@ -0,0 +1,100 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('qgis.core')
+pytest.importorskip('processing')
+
+from qgis.core import QgsProcessingFeedback, QgsRectangle
+
+from DownloadCuzkElevationData import TileIndex, TileManifest, entry_footprint, feed_tiles
+
+# feed in the JSON form of the ATOM service, written by hand with tiles of known footprints
+FEED_PATH = Path(__file__).parent / 'data' / 'cuzk_feed_dmr5g.json'
+
+TILE_URL = 'https://openzu.cuzk.gov.cz/opendata/DMR5G-SJTSK/epsg-5514/{}.zip'
+
+
+@pytest.fixture
+def feed():
+    return json.loads(FEED_PATH.read_text(encoding='utf-8'))
+
+
+def tile_names(tiles):
+    return sorted(Path(tile[0]).stem for tile in tiles)
+
+
+def test_footprints_in_wgs84_only(feed):
+
+    footprints = {Path(entry['id']).stem: entry_footprint(entry) for entry in feed['entry']}
+
+    assert footprints['PRAH72'].boundingBox() == QgsRectangle(14.4, 50.0, 14.5, 50.1)
+    assert footprints['BRNO24'].boundingBox() == QgsRectangle(16.5, 49.15, 16.65, 49.25)
+    # S-JTSK coordinates are outside WGS 84 bounds
+    assert footprints['PLZE41'] is None
+    assert footprints['OSTR12'] is None
+
+
+def test_feed_tiles_keep_entries_without_footprint(feed):
+
+    tiles = feed_tiles(feed)
+
+    assert tile_names(tiles) == ['BRNO24', 'OSTR12', 'PLZE41', 'PRAH72', 'PRAH73']
+    updates = {Path(link).stem: updated for link, updated, _ in tiles}
+
+    assert updates['BRNO24'] == '2024-01-15T00:00:00Z'
+
+
+def test_index_lookup(feed):
+
+    tile_index = TileIndex(feed)
+
+    assert len(tile_index.tiles_list) == 3
+
+    assert tile_names(tile_index.tiles(QgsRectangle(14.41, 50.01, 14.42, 50.02))) == ['PRAH72']
+    assert tile_names(tile_index.tiles(QgsRectangle(14.45, 50.01, 14.55,
+                                                    50.02))) == ['PRAH72', 'PRAH73']
+    assert tile_names(tile_index.tiles(QgsRectangle(16.6, 49.2, 16.7, 49.3))) == ['BRNO24']
+    assert tile_index.tiles(QgsRectangle(12.0, 50.5, 12.1, 50.6)) == []
+
+
+def test_load_uses_cached_feed(feed, tmp_path):
+
+    path = tmp_path / 'DMR5G.json'
+    path.write_text(json.dumps(feed), encoding='utf-8')
+
+    tile_index = TileIndex.load(path, 'DMR5G', 3600, QgsProcessingFeedback())
+
+    assert tile_index is not None
+    assert tile_names(tile_index.tiles(QgsRectangle(16.6, 49.2, 16.7, 49.3))) == ['BRNO24']
+
+
+def test_load_without_footprints(feed, tmp_path):
+
+    feed['entry'] = [entry for entry in feed['entry'] if entry_footprint(entry) is None]
+
+    path = tmp_path / 'DMR5G.json'
+    path.write_text(json.dumps(feed), encoding='utf-8')
+
+    assert TileIndex.load(path, 'DMR5G', 3600, QgsProcessingFeedback()) is None
+
+
+def test_manifest_covers_extent_across_tile_edge(feed, tmp_path):
+
+    manifest = TileManifest(tmp_path)
+
+    for link, updated, footprint in feed_tiles(feed):
+        if Path(link).stem.startswith('PRAH'):
+            file_name = '{}.laz'.format(Path(link).stem)
+            (tmp_path / file_name).write_bytes(b'')
+            manifest.add(link, updated, 'DMR5G', [file_name], footprint)
+
+    assert manifest.covers(QgsRectangle(14.45, 50.01, 14.55, 50.09), 'DMR5G')
+    assert not manifest.covers(QgsRectangle(14.55, 50.01, 14.65, 50.09), 'DMR5G')
+    assert not manifest.covers(QgsRectangle(14.45, 50.01, 14.55, 50.09), 'DMR4G')
+
+    os.remove(tmp_path / 'PRAH73.laz')
+
+    assert not manifest.covers(QgsRectangle(14.45, 50.01, 14.55, 50.09), 'DMR5G')
@@ -0,0 +1,156 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+pytest.importorskip('qgis.core')
+pytest.importorskip('processing')
+
+from qgis.core import QgsProcessingException
+
+from DownloadCuzkElevationData import extract_point_clouds, stream_point_clouds, zip64_sizes
+
+MEMBERS = {
+    'tile.laz': os.urandom(50000) + b'point cloud' * 5000,
+    'las/tile.LAS': b'\x00' * 100000,
+    'metadata.xml': b'<metadata/>',
+    'empty.las': b'',
+}
+
+
+class UnseekableWriter:
+
+    # zipfile writes members with data descriptors to streams it can not seek in
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return self.buffer.getvalue()
+
+
+class ShortReads(io.BytesIO):
+
+    # network responses return less data than requested
+    def read(self, size=-1):
+        return super().read(min(size, 1000) if size is not None and size >= 0 else size)
+
+
+def archive(compression=zipfile.ZIP_DEFLATED, seekable=True, force_zip64=False,
+            members=None) -> bytes:
+
+    output = io.BytesIO() if seekable else UnseekableWriter()
+
+    with zipfile.ZipFile(output, 'w', compression=compression) as zip_file:
+        # directory written to non seekable stream would be stored member with data descriptor
+        if seekable:
+            zip_file.writestr(zipfile.ZipInfo('las/'), b'')
+        for name, data in (members or MEMBERS).items():
+            info = zipfile.ZipInfo(name)
+            info.compress_type = compression
+            with zip_file.open(info, 'w', force_zip64=force_zip64) as member:
+                member.write(data)
+
+    return output.getvalue()
+
+
+def check_extracted(folder, files):
+
+    assert sorted(files) == ['empty.las', 'las/tile.LAS', 'tile.laz']
+
+    for name in files:
+        assert (folder / name).read_bytes() == MEMBERS[name]
+
+    assert not (folder / 'metadata.xml').exists()
+    assert not list(folder.rglob('*.part'))
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+@pytest.mark.parametrize('force_zip64', [False, True])
+def test_seekable_archive(tmp_path, compression, force_zip64):
+
+    data = archive(compression, force_zip64=force_zip64)
+
+    check_extracted(tmp_path, stream_point_clouds(io.BytesIO(data), tmp_path, chunk_size=777))
+
+
+@pytest.mark.parametrize('force_zip64', [False, True])
+def test_data_descriptors(tmp_path, force_zip64):
+
+    data = archive(seekable=False, force_zip64=force_zip64)
+
+    check_extracted(tmp_path, stream_point_clouds(ShortReads(data), tmp_path, chunk_size=777))
+
+
+def test_stored_member_with_data_descriptor(tmp_path):
+
+    # end of stored member is not known without its size
+    data = archive(zipfile.ZIP_STORED, seekable=False)
+
+    with pytest.raises(QgsProcessingException, match='can not be extracted while downloading'):
+        stream_point_clouds(io.BytesIO(data), tmp_path)
+
+
+def test_crc_mismatch(tmp_path):
+
+    data = bytearray(archive(zipfile.ZIP_STORED, members={'tile.laz': b'abcdefgh' * 100}))
+
+    position = data.index(b'abcdefgh')
+    data[position] ^= 0xFF
+
+    with pytest.raises(QgsProcessingException, match='CRC check'):
+        stream_point_clouds(io.BytesIO(bytes(data)), tmp_path)
+
+    assert not list(tmp_path.rglob('*.laz*'))
+
+
+def test_truncated_archive(tmp_path):
+
+    data = archive()
+
+    with pytest.raises(QgsProcessingException, match='Unexpected end'):
+        stream_point_clouds(io.BytesIO(data[:len(data) // 2]), tmp_path)
+
+
+def test_member_outside_folder_not_extracted(tmp_path):
+
+    folder = tmp_path / 'output'
+
+    data = archive(members={'../outside.laz': b'outside', 'inside.laz': b'inside'})
+
+    assert stream_point_clouds(io.BytesIO(data), folder) == ['inside.laz']
+    assert not (tmp_path / 'outside.laz').exists()
+
+
+def test_zip64_sizes():
+
+    extra = b'\x99\x99\x02\x00ab' + b'\x01\x00\x10\x00' + (5).to_bytes(8, 'little') + (
+        3).to_bytes(8, 'little')
+
+    assert zip64_sizes(extra, 0xFFFFFFFF, 0xFFFFFFFF) == (3, 5)
+    # only sizes set to 0xFFFFFFFF in the local header are stored in the extra field
+    assert zip64_sizes(extra, 10, 0xFFFFFFFF) == (10, 5)
+    assert zip64_sizes(b'', 10, 20) == (10, 20)
+
+
+def test_extract_corrupted_archive(tmp_path):
+
+    data = bytearray(archive(zipfile.ZIP_STORED, members={'tile.laz': b'abcdefgh' * 100}))
+
+    position = data.index(b'abcdefgh')
+    data[position] ^= 0xFF
+
+    zip_path = tmp_path / 'tile.zip'
+    zip_path.write_bytes(bytes(data))
+
+    # CRC is checked while extracting, without separate test of the archive
+    with pytest.raises(zipfile.BadZipFile):
+        extract_point_clouds(zip_path, tmp_path / 'output')
+
+    assert not (tmp_path / 'output' / 'tile.laz').exists()